@@ -0,0 +1,92 @@
+"""Peak memory of turning one large upload into thumbnails.
+
+Writes a --width x --height JPEG and PNG, then in a fresh process per case
+decodes them the old way (full decode, then resize) and through
+incidentlogger.images.decode (header checks plus JPEG draft mode). Prints
+how far each process's peak RSS rose above its baseline.
+
+    python benchmarks/image_memory.py [--width 6000] [--height 4000]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from PIL import Image
+
+
+def full_decode(path):
+    with Image.open(path) as image:
+        image.load()
+        image = image.copy()
+    image.thumbnail((500, 500), Image.LANCZOS)
+    return image
+
+
+def bounded_decode(path):
+    from incidentlogger.images import decode
+    return decode(path, 500)[0]
+
+
+def measure(case, path, results):
+    # Imports first, so they count toward the baseline, not the decode.
+    import incidentlogger.images
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    CASES[case](path)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(((peak - baseline) / 1024, elapsed))
+
+
+CASES = {'full decode': full_decode, 'bounded decode': bounded_decode}
+
+
+def make_images(directory, width, height):
+    # A gradient with noise compresses like a photo, not like a flat fill.
+    image = Image.merge('RGB', [Image.linear_gradient('L').resize((width, height)),
+                                Image.effect_noise((width, height), 40),
+                                Image.linear_gradient('L').rotate(90).resize((width, height))])
+    for fmt, path in image_paths(directory).items():
+        image.save(path, fmt)
+
+
+def image_paths(directory):
+    return {'JPEG': os.path.join(directory, 'upload.jpg'), 'PNG': os.path.join(directory, 'upload.png')}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    args = parser.parse_args()
+
+    # Every step runs in its own process: ru_maxrss survives fork and exec,
+    # so a parent that had held the full-size image would inflate every
+    # baseline.
+    context = multiprocessing.get_context('spawn')
+    directory = tempfile.mkdtemp()
+    process = context.Process(target=make_images, args=(directory, args.width, args.height))
+    process.start()
+    process.join()
+    paths = image_paths(directory)
+    print(f'{args.width}x{args.height} upload')
+    print(f'{"format":6} {"case":16} {"peak MB":>8} {"seconds":>8}')
+    for fmt, path in paths.items():
+        for case in CASES:
+            results = context.Queue()
+            process = context.Process(target=measure, args=(case, path, results))
+            process.start()
+            peak, elapsed = results.get()
+            process.join()
+            print(f'{fmt:6} {case:16} {peak:8.1f} {elapsed:8.2f}')
+
+
+if __name__ == '__main__':
+    main()
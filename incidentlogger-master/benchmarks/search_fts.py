@@ -0,0 +1,80 @@
+"""Full-text search latency at scale.
+
+Fills a scratch database with --rows posts (the FTS triggers index them
+as they are inserted), then times the /search query against the
+LIKE '%term%' scan it replaces.
+
+    python benchmarks/search_fts.py [--rows 1000000] [--repeat 20]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from incidentlogger import app, db
+from incidentlogger.search import search
+
+SYLLABLES = 'ka lo mi ne ru sa te vo zu pi ba de fo gu hi'.split()
+# A Zipf-like vocabulary, so some terms are in most rows and some in few.
+WORDS = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+WEIGHTS = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+
+def fill(rows):
+    rng = random.Random(0)
+    cum_weights = list(itertools.accumulate(WEIGHTS))
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO user (username, email, email_normalized, image_file, password, priv)"
+                             " VALUES ('bench', 'bench@example.com', 'bench@example.com', 'default.jpg', 'x', 0)")
+        batch = []
+        for i in range(rows):
+            title = ' '.join(rng.choices(WORDS, cum_weights=cum_weights, k=4))
+            content = ' '.join(rng.choices(WORDS, cum_weights=cum_weights, k=40))
+            batch.append((title, '2020-01-01 00:00:00', content, 1))
+            if len(batch) == 10000:
+                conn.exec_driver_sql('INSERT INTO post (title, date_posted, content, user_id)'
+                                     ' VALUES (?, ?, ?, ?)', batch)
+                batch = []
+        if batch:
+            conn.exec_driver_sql('INSERT INTO post (title, date_posted, content, user_id)'
+                                 ' VALUES (?, ?, ?, ?)', batch)
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with app.app_context():
+        fill(args.rows)
+        print(f'inserted and indexed {args.rows} posts in {time.perf_counter() - start:.1f}s')
+        like = text('SELECT id, title FROM post WHERE title LIKE :q OR content LIKE :q'
+                    ' ORDER BY date_posted DESC, id DESC LIMIT 20')
+        # A common, a mid-frequency and a rare term, then two terms together.
+        queries = (WORDS[5], WORDS[300], WORDS[3000], f'{WORDS[40]} {WORDS[900]}')
+        for q in queries:
+            fts = timed(lambda: search(q, ['post']), args.repeat)
+            scan = timed(lambda: db.session.execute(
+                like, {'q': f'%{q}%'}).all(), max(1, args.repeat // 4))
+            print(f'{q!r:16} fts5+bm25 {fts:8.2f} ms   LIKE scan {scan:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Read/write throughput of site.db with concurrent writers.
+
+Runs the same mixed workload against a scratch database once per SQLite
+profile (see incidentlogger/sqlite.py) and prints operations per second
+and how many operations failed with "database is locked".
+
+    python benchmarks/sqlite_concurrency.py [--writers 4] [--readers 8] [--seconds 5]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import create_engine
+from incidentlogger import app, db
+from incidentlogger.sqlite import PROFILES, connection_factory
+
+
+def writer(connect, stop, counts):
+    conn = connect()
+    while not stop.is_set():
+        try:
+            now = datetime.now().isoformat(' ')
+            cur = conn.execute(
+                'INSERT INTO incident (category, title, date_posted, content, tags, contact,'
+                ' state, current_assignee, history, user_id)'
+                " VALUES ('bench', 'title', ?, 'content', 'tags', 'bench', 'Inactive', ' ', 'Created', 1)",
+                (now,))
+            conn.execute("UPDATE incident SET history = history || ' Updated', state = 'Active'"
+                         ' WHERE id = ?', (cur.lastrowid,))
+            conn.commit()
+            counts['writes'] += 1
+        except sqlite3.OperationalError:
+            conn.rollback()
+            counts['errors'] += 1
+    conn.close()
+
+
+def reader(connect, stop, counts):
+    conn = connect()
+    while not stop.is_set():
+        try:
+            conn.execute('SELECT id, title FROM incident ORDER BY date_posted DESC, id DESC'
+                         ' LIMIT 6').fetchall()
+            counts['reads'] += 1
+        except sqlite3.OperationalError:
+            counts['errors'] += 1
+    conn.close()
+
+
+def run(profile, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db.metadata.create_all(create_engine('sqlite:///' + path))
+    retries = app.config['SQLITE_BUSY_RETRIES'] if profile != 'default' else 0
+    factory = connection_factory(PROFILES[profile], retries, app.config['SQLITE_BUSY_BACKOFF'],
+                                 app.config['SQLITE_BUSY_MAX_WAIT'])
+    connect = lambda: sqlite3.connect(path, factory=factory, check_same_thread=False)
+
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    threads = [threading.Thread(target=writer, args=(connect, stop, counts))
+               for _ in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(connect, stop, counts))
+                for _ in range(args.readers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {k: v / args.seconds for k, v in counts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{args.writers} writers, {args.readers} readers, {args.seconds}s per profile')
+    print(f'{"profile":12} {"reads/s":>10} {"writes/s":>10} {"locked/s":>10}')
+    for profile in ('default', 'production'):
+        r = run(profile, args)
+        print(f'{profile:12} {r["reads"]:10.0f} {r["writes"]:10.0f} {r["errors"]:10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Requests per second from each way of serving the app.
+
+Seeds a scratch database, then starts each server in turn on a free port
+(the single-process Flask development server, serve.py, and gunicorn with
+gunicorn.conf.py if it is installed) and has --clients processes fetch
+--path back to back for --seconds. Prints requests per second, the mean
+and 99th percentile latency, and any errors.
+
+    python benchmarks/wsgi_throughput.py [--clients 16] [--seconds 10] [--path /home]
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SERVERS = {
+    'flask dev server': [sys.executable, '-c',
+                         'import os; from run import app;'
+                         " app.run(port=int(os.environ['BIND'].rsplit(':', 1)[1]), threaded=True)"],
+    'serve.py': [sys.executable, 'serve.py'],
+    'gunicorn': ['gunicorn', '-c', 'gunicorn.conf.py'],
+}
+
+
+def seed(url):
+    os.environ['DATABASE_URL'] = url
+    from datetime import datetime, timedelta
+    from incidentlogger import app, db
+    from incidentlogger.models import Post, User
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com', password='x')
+        db.session.add(user)
+        for i in range(50):
+            db.session.add(Post(title=f'Post {i}', content='Some content. ' * 20, author=user,
+                                date_posted=datetime(2020, 1, 1) + timedelta(hours=i)))
+        db.session.commit()
+
+
+def client(port, path, seconds, results):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if response.status != 200:
+                raise OSError(response.status)
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.monotonic() - started)
+    results.put((latencies, errors))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, path, process):
+    for _ in range(300):
+        if process.poll() is not None:
+            return False
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', path)
+            conn.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def run(name, command, env, args):
+    port = free_port()
+    env = dict(env, BIND=f'127.0.0.1:{port}')
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_until_up(port, args.path, process):
+            print(f'{name:18} did not start')
+            return
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(port, args.path, args.seconds, results))
+                   for _ in range(args.clients)]
+        for c in clients:
+            c.start()
+        latencies, errors = [], 0
+        for _ in clients:
+            got, failed = results.get()
+            latencies += got
+            errors += failed
+        for c in clients:
+            c.join()
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    mean = sum(latencies) / len(latencies) * 1000 if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    print(f'{name:18} {len(latencies) / args.seconds:8.0f} {mean:8.1f} {p99:8.1f} {errors:6}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--path', default='/home')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    process = multiprocessing.get_context('spawn').Process(target=seed, args=(url,))
+    process.start()
+    process.join()
+    env = dict(os.environ, DATABASE_URL=url)
+
+    print(f'GET {args.path}, {args.clients} clients, {args.seconds}s,'
+          f" {env.get('WEB_CONCURRENCY', os.cpu_count())} workers for serve.py and gunicorn")
+    print(f'{"server":18} {"req/s":>8} {"mean ms":>8} {"p99 ms":>8} {"errors":>6}')
+    for name, command in SERVERS.items():
+        if shutil.which(command[0]) is None:
+            print(f'{name:18} not installed')
+            continue
+        run(name, command, env, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Production server settings, read by gunicorn (`gunicorn -c gunicorn.conf.py`)
+# and by the stdlib fallback in serve.py. Each setting can be overridden
+# from the environment.
+import gc
+import os
+
+wsgi_app = 'run:app'
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+
+# Import the app (and run migrations) once in the master; workers start
+# from a copy of it instead of each importing it again.
+preload_app = True
+
+# Recycle a worker after this many requests, give or take the jitter so
+# workers do not all restart together. 0 turns recycling off.
+max_requests = int(os.environ.get('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 100))
+# Seconds a stopping worker gets to finish its requests before it is killed.
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = 60
+
+# The collector would touch (and so copy) every object the preloaded app
+# made while walking them. It stays off in the master; objects that exist
+# at fork time are frozen out of collection and workers turn it back on,
+# so those pages stay shared between workers.
+gc.disable()
+
+
+def before_fork():
+    from incidentlogger import app, db
+    # Connections opened while preloading must not be shared with workers.
+    with app.app_context():
+        db.engine.dispose()
+    gc.freeze()
+
+
+def after_fork():
+    gc.enable()
+
+
+def pre_fork(server, worker):
+    before_fork()
+
+
+def post_fork(server, worker):
+    after_fork()
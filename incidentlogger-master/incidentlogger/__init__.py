@@ -1,16 +1,65 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
+from flask_mail import Mail
+from incidentlogger.sqlite import engine_options
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
+app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+app.config['SQLITE_BUSY_RETRIES'] = 5
+app.config['SQLITE_BUSY_BACKOFF'] = 0.05
+app.config['SQLITE_BUSY_MAX_WAIT'] = 1.0
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+app.config['AUTO_MIGRATE'] = True
+app.config['LAZY_LOAD_DETECTION'] = 'warn'
+app.config['CATEGORY_CACHE_TTL'] = 5
+app.config['LISTING_TOTALS'] = 'exact'
+app.config['APPROXIMATE_TOTALS_TTL'] = 30
+app.config['PAGE_CACHE'] = os.environ.get('PAGE_CACHE', 'lru')
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['PAGE_CACHE_SIZE'] = 512
+app.config['PAGE_CACHE_DIR'] = None
+app.config['PAGE_CACHE_URL'] = os.environ.get('PAGE_CACHE_URL', 'redis://localhost:6379/0')
+app.config['FRAGMENT_CACHE_SIZE'] = 2048
+app.config['FRAGMENT_CACHE_TTL'] = 3600
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 30
+app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+app.config['IMAGE_MAX_PIXELS'] = 24000000
+app.config['THUMBNAIL_WORKERS'] = 2
+app.config['THUMBNAIL_QUEUE'] = 32
+app.config['IMAGE_GC_GRACE'] = 24 * 3600
+app.config['IMAGE_GC_INTERVAL'] = None
+app.config['BCRYPT_LOG_ROUNDS'] = 12
+app.config['PASSWORD_WORKERS'] = 2
+app.config['PASSWORD_WAIT'] = 10
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_SIZE'] = 100000
+app.config['RATE_LIMIT_PATH'] = None
+app.config['RATE_LIMITS'] = {}
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))
+app.config['MAIL_DEFAULT_SENDER'] = 'noreply@demo.com'
+app.config['MAIL_OUTBOX_SENDER'] = True
+app.config['MAIL_BATCH_SIZE'] = 50
+app.config['MAIL_LEASE'] = 300
+app.config['MAIL_MAX_ATTEMPTS'] = 8
+app.config['MAIL_RETRY_BACKOFF'] = 30
+app.config['MAIL_POLL_INTERVAL'] = 30
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
 db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
+mail = Mail(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
-from incidentlogger import routes
\ No newline at end of file
+from incidentlogger import routes, commands, metrics, fragments, users, assets, ratelimit, outbox
+from incidentlogger.migrations import upgrade_db
+
+if app.config['AUTO_MIGRATE']:
+    with app.app_context():
+        upgrade_db()
@@ -0,0 +1,239 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import urllib.request
+from flask import request, send_from_directory, url_for
+from incidentlogger import app
+
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Third-party files, pinned by their subresource integrity hash. `flask
+# assets-vendor` fetches them into static/vendor/ once, on a machine with
+# internet access; everything after that works offline.
+VENDOR = {
+    'vendor/bootstrap.min.css': (
+        'https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css',
+        'sha384-Gn5384xqQ1aoWXA+058RXPxPg6fy4IWvTNh0E263XmFcJlSAwiGgFAW/dAiS6JXm'),
+    'vendor/jquery.slim.min.js': (
+        'https://code.jquery.com/jquery-3.2.1.slim.min.js',
+        'sha384-KJ3o2DKtIkvYIK3UENzmM7KCkRr/rE9/Qpg6aAZGJwFDMVNA/GpGFF93hXpG5KkN'),
+    'vendor/popper.min.js': (
+        'https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.12.9/umd/popper.min.js',
+        'sha384-ApNbgh9B+Y1QKtv3Rn7W3mgPxhU9K/ScQsAP7hUibX39j7fakFPskvXusvfa0b4Q'),
+    'vendor/bootstrap.min.js': (
+        'https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/js/bootstrap.min.js',
+        'sha384-JZR6Spejh4U02d8jOt6vLEHfe/JQGiRRSQQxSfFWpi1MquVdAyjUar5+76PVCmYl'),
+}
+
+# Bundles under static/dist/, in the order the layout used to load them.
+BUNDLES = {
+    'site.css': ['vendor/bootstrap.min.css', 'main.css'],
+    'site.js': ['vendor/jquery.slim.min.js', 'vendor/popper.min.js', 'vendor/bootstrap.min.js'],
+}
+
+
+class Manifest:
+    # Content hashes of static files, keyed by their path under static/.
+    # `flask assets-manifest` writes them to static/manifest.json at deploy
+    # time; files added later (uploads) are hashed once on first use. In
+    # debug mode entries are re-checked against the file's mtime so edits
+    # to main.css show up without a rebuild.
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, 'manifest.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def hash_file(self, filename):
+        path = os.path.join(self.folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        except OSError:
+            return None
+        with self.lock:
+            self.entries[filename] = [digest, mtime]
+        return digest
+
+    def get(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None:
+            return self.hash_file(filename)
+        if app.debug:
+            try:
+                if os.path.getmtime(os.path.join(self.folder, filename)) != entry[1]:
+                    return self.hash_file(filename)
+            except OSError:
+                return None
+        return entry[0]
+
+    def build(self):
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                filename = os.path.relpath(os.path.join(root, name), self.folder).replace(os.sep, '/')
+                if filename != 'manifest.json':
+                    self.hash_file(filename)
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        return len(self.entries)
+
+
+manifest = Manifest(app.static_folder)
+
+
+def integrity(data):
+    return 'sha384-' + base64.b64encode(hashlib.sha384(data).digest()).decode('ascii')
+
+
+def vendor_assets():
+    fetched = []
+    for filename, (url, expected) in VENDOR.items():
+        path = os.path.join(app.static_folder, filename)
+        if os.path.exists(path):
+            continue
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        if integrity(data) != expected:
+            raise RuntimeError(f'{url} does not match its pinned integrity hash')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        fetched.append(filename)
+    return fetched
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    # Not ':', whose surrounding space can be a descendant combinator
+    # ('.a :hover' is not '.a:hover').
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def build_bundles():
+    # Concatenates each bundle (the vendored files are already minified),
+    # minifies the CSS and writes .gz and, if the brotli package is
+    # installed, .br next to it for clients that accept them.
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    dist = os.path.join(app.static_folder, 'dist')
+    os.makedirs(dist, exist_ok=True)
+    built = []
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(app.static_folder, source), encoding='utf-8') as f:
+                parts.append(f.read())
+        if name.endswith('.css'):
+            data = minify_css('\n'.join(parts))
+        else:
+            data = ';\n'.join(part.strip().rstrip(';') for part in parts) + ';\n'
+        data = data.encode('utf-8')
+        path = os.path.join(dist, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, 9, mtime=0))
+        if brotli:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+        built.append((name, len(data)))
+    return built
+
+
+def bundle_url(name):
+    # Only bundles recorded in the manifest are used, so a checkout that
+    # has not run `flask assets-build` keeps the CDN links.
+    if f'dist/{name}' not in manifest.entries:
+        return None
+    return url_for('static', filename=f'dist/{name}')
+
+
+app.jinja_env.globals['bundle_url'] = bundle_url
+
+deployed = None
+
+
+def deploy_stamp():
+    # (version, mtime) of what every rendered page embeds: the fingerprints
+    # of the assets the layout links and the templates themselves. It
+    # changes with each deploy that touches them, so conditional GETs mix it
+    # into their validators and a browser does not keep HTML pointing at
+    # last deploy's ?v= URLs.
+    global deployed
+    if deployed is None or app.debug:
+        digest = hashlib.sha1()
+        newest = 0
+        for filename in ['main.css'] + [f'dist/{name}' for name in BUNDLES]:
+            digest.update(f'{filename}={manifest.get(filename)}\n'.encode('utf-8'))
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(app.static_folder, filename)))
+            except OSError:
+                pass
+        templates = os.path.join(app.root_path, app.template_folder)
+        for root, dirs, files in os.walk(templates):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+                newest = max(newest, os.path.getmtime(path))
+        deployed = (digest.hexdigest()[:12], newest)
+    return deployed
+
+
+@app.before_request
+def precompressed_bundle():
+    # Serve dist/x.br or dist/x.gz in place of dist/x when the client
+    # accepts it; the fingerprint headers are added by cache_fingerprinted.
+    if request.endpoint != 'static':
+        return None
+    filename = request.view_args['filename']
+    if not filename.startswith('dist/') or filename.endswith(('.gz', '.br')):
+        return None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in request.accept_encodings and \
+                os.path.exists(os.path.join(app.static_folder, filename + suffix)):
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype='text/css' if filename.endswith('.css')
+                                           else 'application/javascript')
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    # url_for('static', filename=...) gains ?v=<content hash>, so a URL
+    # only ever names one version of a file and can be cached for good.
+    if endpoint == 'static' and 'v' not in values:
+        digest = manifest.get(values.get('filename', ''))
+        if digest:
+            values['v'] = digest
+
+
+@app.after_request
+def cache_fingerprinted(response):
+    if request.endpoint == 'static' and response.status_code == 200:
+        version = request.args.get('v')
+        if version and version == manifest.get(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+    return response
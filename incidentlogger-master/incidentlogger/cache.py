@@ -0,0 +1,196 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, make_response
+from flask_login import current_user
+from incidentlogger import app, db
+from incidentlogger.metrics import metrics
+from incidentlogger.models import ContentVersion
+
+
+# Each content group has a version bumped by a trigger whenever one of its
+# rows changes, inside the writing transaction. Cache keys include the
+# versions of the groups a page shows, so a commit from any route or
+# worker retires exactly the pages that could have changed.
+VERSIONED = ('post', 'game', 'incident')
+
+
+def version_ddl():
+    bump = "INSERT INTO content_version (name, version) VALUES ('{group}', 1)" \
+           " ON CONFLICT (name) DO UPDATE SET version = version + 1;"
+    ddl = []
+    for table in VERSIONED:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            ddl.append(f'CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}'
+                       f' AFTER {event} ON {table} BEGIN {bump.format(group=table)} END')
+    # Cards show the author's name and avatar.
+    ddl.append('CREATE TRIGGER IF NOT EXISTS user_version_update'
+               ' AFTER UPDATE OF username, image_file ON user BEGIN'
+               f" {bump.format(group='user')} END")
+    return ddl
+
+
+def create_version_triggers(conn):
+    for statement in version_ddl():
+        conn.exec_driver_sql(statement)
+
+
+class LRUBackend:
+    def __init__(self, config, name='page_cache'):
+        self.name = name
+        self.size = config[name.upper() + '_SIZE']
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                metrics.inc(f'{self.name}.evictions')
+
+
+class FileBackend:
+    # One file per page under PAGE_CACHE_DIR, shared by every worker on the
+    # host. The first line of each file is its expiry time.
+    #
+    # Keys carry content versions, so most entries are never read again
+    # once a write retires them. Each process therefore sweeps the
+    # directory at most once a minute: files older than PAGE_CACHE_TTL
+    # go, then the oldest until at most PAGE_CACHE_SIZE are left.
+
+    sweep_interval = 60
+
+    def __init__(self, config):
+        self.directory = config['PAGE_CACHE_DIR'] or os.path.join(app.instance_path, 'page_cache')
+        self.size = config['PAGE_CACHE_SIZE']
+        self.ttl = config['PAGE_CACHE_TTL']
+        self.next_sweep = 0
+        self.sweep_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires = float(f.readline())
+                if expires < time.time():
+                    os.remove(path)
+                    return None
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value, ttl):
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'wb') as f:
+            f.write(b'%f\n' % (time.time() + ttl))
+            f.write(value)
+        os.replace(tmp, path)
+        if time.monotonic() >= self.next_sweep and self.sweep_lock.acquire(blocking=False):
+            try:
+                self.next_sweep = time.monotonic() + self.sweep_interval
+                self.sweep()
+            finally:
+                self.sweep_lock.release()
+
+    def sweep(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    files.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        files.sort(reverse=True)
+        cutoff = time.time() - self.ttl
+        for n, (mtime, path) in enumerate(files):
+            if mtime < cutoff or n >= self.size:
+                try:
+                    os.remove(path)
+                    metrics.inc('page_cache.evictions')
+                except OSError:
+                    pass
+
+
+class RedisBackend:
+    # Any server speaking the Redis protocol on PAGE_CACHE_URL.
+
+    def __init__(self, config):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("PAGE_CACHE = 'redis' needs the redis package installed")
+        self.client = redis.Redis.from_url(config['PAGE_CACHE_URL'])
+
+    def get(self, key):
+        return self.client.get('page:' + key)
+
+    def set(self, key, value, ttl):
+        self.client.setex('page:' + key, ttl, value)
+
+
+BACKENDS = {'lru': LRUBackend, 'file': FileBackend, 'redis': RedisBackend}
+
+backend = None
+
+
+def get_backend():
+    global backend
+    if backend is None and app.config['PAGE_CACHE']:
+        backend = BACKENDS[app.config['PAGE_CACHE']](app.config)
+    return backend
+
+
+def content_versions(groups):
+    rows = db.session.query(ContentVersion.name, ContentVersion.version)\
+        .filter(ContentVersion.name.in_(groups))
+    versions = dict(rows)
+    return ','.join(f'{g}={versions.get(g, 0)}' for g in groups)
+
+
+def cached_page(*groups):
+    # Caches the rendered page for anonymous GETs. Logged-in users see
+    # their own nav bar and flashed messages are one-off, so both bypass.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = get_backend()
+            if cache is None or current_user.is_authenticated or session.get('_flashes'):
+                return view(*args, **kwargs)
+            args_key = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+            key = f'{request.path}|{args_key}|{content_versions(groups)}'
+            body = cache.get(key)
+            if body is not None:
+                metrics.inc(f'page_cache.hits.{request.endpoint}')
+                return make_response(body)
+            metrics.inc(f'page_cache.misses.{request.endpoint}')
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, response.get_data(), app.config['PAGE_CACHE_TTL'])
+            return response
+        return wrapper
+    return decorator
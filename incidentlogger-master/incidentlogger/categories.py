@@ -0,0 +1,51 @@
+import threading
+import time
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from incidentlogger import app, db
+from incidentlogger.models import Category
+
+
+class CategoryRegistry:
+    # Category names cached per process. Categories are only ever added, so
+    # MAX(category.id) is a version stamp shared by every worker: it is read
+    # at most once per CATEGORY_CACHE_TTL seconds and the set is reloaded
+    # when another worker has added a name.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = set()
+        self.version = None
+        self.checked = 0
+
+    def current_version(self):
+        return db.session.query(func.max(Category.id)).scalar() or 0
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.version is not None and now - self.checked < app.config['CATEGORY_CACHE_TTL']:
+            return
+        version = self.current_version()
+        if version != self.version:
+            names = {name for name, in db.session.query(Category.name)}
+            with self.lock:
+                self.names, self.version = names, version
+        self.checked = now
+
+    def all(self):
+        self.refresh()
+        return sorted(self.names)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.names
+
+    def add(self, name):
+        if name in self:
+            return
+        db.session.execute(insert(Category).values(name=name).on_conflict_do_nothing())
+        # Reload on next use rather than trusting a row that may yet roll back.
+        self.version = None
+
+
+categories = CategoryRegistry()
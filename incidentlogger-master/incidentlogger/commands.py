@@ -0,0 +1,133 @@
+from datetime import datetime
+import click
+from sqlalchemy import tuple_
+from incidentlogger import app, db
+from incidentlogger.migrations import upgrade_db, current_version
+from incidentlogger.search import rebuild_search_index
+from incidentlogger.assets import manifest, vendor_assets, build_bundles
+from incidentlogger.images import collect_garbage
+from incidentlogger.outbox import flush
+from incidentlogger.models import Incident, IncidentEvent, Game, Post, game_tags, incident_tags
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Bring site.db up to the latest schema version."""
+    with db.engine.connect() as conn:
+        before = current_version(conn)
+    after = upgrade_db()
+    click.echo(f'Schema version {before} -> {after}')
+
+
+@app.cli.command('search-rebuild')
+def search_rebuild():
+    """Rebuild the full-text search indexes from their tables."""
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    click.echo('Search indexes rebuilt')
+
+
+@app.cli.command('assets-manifest')
+def assets_manifest():
+    """Hash every static file into static/manifest.json."""
+    click.echo(f'{manifest.build()} files in {manifest.path}')
+
+
+@app.cli.command('assets-vendor')
+def assets_vendor():
+    """Download the pinned third-party CSS and JS into static/vendor/."""
+    for filename in vendor_assets():
+        click.echo(f'Fetched {filename}')
+
+
+@app.cli.command('assets-build')
+def assets_build():
+    """Bundle, minify and precompress the site CSS and JS, then rebuild the manifest."""
+    for name, size in build_bundles():
+        click.echo(f'dist/{name}: {size} bytes')
+    click.echo(f'{manifest.build()} files in {manifest.path}')
+
+
+@app.cli.command('images-gc')
+@click.option('--grace', type=int, default=None,
+              help='Only touch files older than this many seconds (default IMAGE_GC_GRACE).')
+@click.option('--quarantine', is_flag=True, help='Move files to instance/quarantine/ instead of deleting.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be reclaimed.')
+def images_gc(grace, quarantine, dry_run):
+    """Remove uploaded images no user or game refers to."""
+    if grace is None:
+        grace = app.config['IMAGE_GC_GRACE']
+    files, reclaimed = collect_garbage(grace, quarantine, dry_run)
+    verb = 'Would reclaim' if dry_run else 'Reclaimed'
+    click.echo(f'{verb} {reclaimed} bytes in {files} files')
+
+
+@app.cli.command('mail-flush')
+def mail_flush():
+    """Send every outbox message that is due now."""
+    click.echo(f'Tried {flush()} messages')
+
+
+def listing_queries():
+    # The shapes the listing routes issue: first page, a seek past a
+    # cursor, and the same two narrowed to one author.
+    seek = (datetime(2000, 1, 1), 1)
+    for model in (Post, Game, Incident):
+        order = (model.date_posted.desc(), model.id.desc())
+        key = tuple_(model.date_posted, model.id)
+        name = model.__tablename__
+        yield f'{name} first page', model.query.order_by(*order).limit(6)
+        yield f'{name} after cursor', \
+            model.query.filter(key < tuple_(*seek)).order_by(*order).limit(6)
+        yield f'{name} by author', \
+            model.query.filter_by(user_id=1).order_by(*order).limit(6)
+        yield f'{name} by author after cursor', \
+            model.query.filter_by(user_id=1).filter(key < tuple_(*seek))\
+            .order_by(*order).limit(6)
+    order = (Incident.date_posted.desc(), Incident.id.desc())
+    yield 'incidents by category', \
+        Incident.query.filter_by(category='x').order_by(*order).limit(6)
+    yield 'incidents by category after cursor', \
+        Incident.query.filter_by(category='x')\
+        .filter(tuple_(Incident.date_posted, Incident.id) < tuple_(*seek))\
+        .order_by(*order).limit(6)
+    for model, link, column in ((Game, game_tags, game_tags.c.game_id),
+                                (Incident, incident_tags, incident_tags.c.incident_id)):
+        order = (link.c.date_posted.desc(), column.desc())
+        tagged = model.query.join(link, column == model.id).filter(link.c.tag_id == 1)
+        yield f'{model.__tablename__}s by tag', tagged.order_by(*order).limit(6)
+        yield f'{model.__tablename__}s by tag after cursor', \
+            tagged.filter(tuple_(link.c.date_posted, column) < tuple_(*seek)).order_by(*order).limit(6)
+    yield 'incident events', \
+        IncidentEvent.query.filter_by(incident_id=1).order_by(IncidentEvent.id.desc())
+
+
+def explain(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    params = tuple(p.isoformat(' ') if isinstance(p, datetime) else p for p in params)
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return [row[-1] for row in rows]
+
+
+def plan_problems(plan):
+    for detail in plan:
+        if 'TEMP B-TREE' in detail:
+            yield detail
+        elif detail.startswith('SCAN') and 'INDEX' not in detail:
+            yield detail
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if a listing query stops using its index."""
+    failed = False
+    for label, query in listing_queries():
+        plan = explain(query)
+        problems = list(plan_problems(plan))
+        status = 'FAIL' if problems else 'ok'
+        click.echo(f'{status:4} {label}: {"; ".join(plan)}')
+        failed = failed or bool(problems)
+    if failed:
+        raise SystemExit(1)
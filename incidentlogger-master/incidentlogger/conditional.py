@@ -0,0 +1,45 @@
+import hashlib
+from datetime import datetime, timezone
+from flask import after_this_request, abort, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from incidentlogger import db
+from incidentlogger.assets import deploy_stamp
+from incidentlogger.models import User
+
+
+def revalidate(model, row_id):
+    # Conditional GET for a detail page. Reads only the row's updated_at and
+    # the author fields the page shows, and returns a 304 if the client's
+    # copy is current; otherwise returns None and the ETag and
+    # Last-Modified headers are put on the rendered response. The viewer is
+    # part of the ETag because the nav bar and buttons depend on who is
+    # logged in, and so is the deploy (templates and asset fingerprints);
+    # Last-Modified is never older than that deploy, so If-Modified-Since
+    # alone cannot keep a page from before it either.
+    if session.get('_flashes'):
+        return None
+    row = db.session.query(model.updated_at, User.username, User.image_file)\
+        .join(User, model.user_id == User.id).filter(model.id == row_id).first()
+    if row is None:
+        abort(404)
+    updated_at, username, image_file = row
+    viewer = current_user.get_id() or 'anonymous'
+    version, deployed_at = deploy_stamp()
+    etag = hashlib.sha1(f'{model.__tablename__}:{row_id}:{updated_at.isoformat()}:'
+                        f'{username}:{image_file}:{viewer}:{version}'.encode('utf-8')).hexdigest()
+    last_modified = max(updated_at.replace(tzinfo=timezone.utc),
+                        datetime.fromtimestamp(int(deployed_at), timezone.utc))
+
+    def add_validators(response):
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return add_validators(make_response('', 304))
+    after_this_request(add_validators)
+    return None
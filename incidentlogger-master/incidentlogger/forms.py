@@ -3,7 +3,8 @@ from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
 from wtforms import StringField, SelectField, DateField, TextAreaField, PasswordField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional
-from incidentlogger.models import User
+from incidentlogger.models import User, normalize_email
+from incidentlogger.images import image_error
 
 
 class RegistrationForm(FlaskForm):
@@ -23,7 +24,7 @@ class RegistrationForm(FlaskForm):
             raise ValidationError('Username not available, Please pick a different one.')
 
     def validate_email(self,email):
-        user = User.query.filter_by(email=email.data).first()
+        user = User.by_email(email.data)
         if user:
             raise ValidationError('An account has already been maid with that email. Please pick a different one or Login.')
 
@@ -53,6 +54,12 @@ class GameForm(FlaskForm):
     date_released = DateField('Date Released', validators=[Optional()])
     submit = SubmitField('Confirm')
 
+    def validate_picture(self, picture):
+        if picture.data:
+            error = image_error(picture.data)
+            if error:
+                raise ValidationError(error)
+
 
 class PostForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired()])
@@ -75,11 +82,17 @@ class UpdateAccountForm(FlaskForm):
                 raise ValidationError('That username is taken. Please choose a different one.')
 
     def validate_email(self, email):
-        if email.data != current_user.email:
-            user = User.query.filter_by(email=email.data).first()
+        if normalize_email(email.data) != current_user.email_normalized:
+            user = User.by_email(email.data)
             if user:
                 raise ValidationError('That email is taken. Please choose a different one.')
 
+    def validate_picture(self, picture):
+        if picture.data:
+            error = image_error(picture.data)
+            if error:
+                raise ValidationError(error)
+
 
 
 class RequestResetForm(FlaskForm):
@@ -88,7 +101,7 @@ class RequestResetForm(FlaskForm):
     submit = SubmitField('Request Password Reset')
 
     def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
+        user = User.by_email(email.data)
         if user is None:
             raise ValidationError('There is no account with that email. You must register first.')
 
@@ -0,0 +1,52 @@
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from incidentlogger import app, db
+from incidentlogger.cache import LRUBackend
+from incidentlogger.metrics import metrics
+
+
+def part_key(part):
+    if isinstance(part, db.Model):
+        return f'{part.__tablename__}:{part.id}:{part.updated_at.isoformat()}'
+    return str(part)
+
+
+class FragmentCache(Extension):
+    # {% cache 'home', post, post.author.username %}...{% endcache %}
+    # Renders the body once per distinct key. Rows key on their table, id
+    # and updated_at, so an edit re-renders only the cards of that row; any
+    # other value the body shows (the author's name, say) goes in the key
+    # as well.
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        self.store = None
+        if app.config['FRAGMENT_CACHE_SIZE']:
+            self.store = LRUBackend(app.config, 'fragment_cache')
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        if self.store is None:
+            return caller()
+        key = '|'.join(part_key(part) for part in parts)
+        html = self.store.get(key)
+        if html is not None:
+            metrics.inc('fragment_cache.hits')
+            return Markup(html)
+        metrics.inc('fragment_cache.misses')
+        html = caller()
+        self.store.set(key, str(html), app.config['FRAGMENT_CACHE_TTL'])
+        return html
+
+
+app.jinja_env.add_extension(FragmentCache)
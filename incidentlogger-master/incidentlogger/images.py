@@ -0,0 +1,413 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from flask import flash, redirect, request, send_from_directory, url_for
+from markupsafe import Markup
+from incidentlogger import app, db
+from incidentlogger.metrics import metrics
+from incidentlogger.models import ImageRef
+
+
+# Shown while an upload is still waiting for its thumbnail.
+PLACEHOLDERS = {'profile_pics': 'default.jpg', 'game_cover': 'yay.jpg'}
+OUTPUT_SIZE = (125, 125)
+# Widths of the variants made for each upload: 1x and 2x of the 65px list
+# avatars and 125px account/cover images, plus a large cover.
+VARIANTS = {'profile_pics': (65, 125, 250), 'game_cover': (65, 125, 250, 500)}
+VARIANT_NAME = re.compile(r'^(.+)-\d+\.(webp|jpg)$')
+WEBP_OPTIONS = {'format': 'WEBP', 'quality': 80, 'method': 6}
+JPEG_OPTIONS = {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}
+CHUNK_SIZE = 64 * 1024
+
+
+def upload_path(folder, filename):
+    return os.path.join(app.instance_path, 'uploads', folder, filename)
+
+
+def static_path(folder, filename):
+    return os.path.join(app.static_folder, folder, filename)
+
+
+def variant_name(filename, width, ext):
+    return f'{os.path.splitext(filename)[0]}-{width}.{ext}'
+
+
+def save_atomic(image, path, **options):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    image.save(tmp, **options)
+    os.replace(tmp, path)
+
+
+def decode(path, largest):
+    # Returns the image already shrunk to fit largest x largest. Sizes are
+    # read from the header, so oversized images are refused before any
+    # pixel is decoded, and JPEGs are decoded straight at 1/2, 1/4 or 1/8
+    # scale (draft mode) when that still covers the largest variant. Peak
+    # memory is then bounded by IMAGE_MAX_PIXELS for other formats and far
+    # below it for JPEG.
+    with Image.open(path) as original:
+        if original.width * original.height > app.config['IMAGE_MAX_PIXELS']:
+            raise ValueError(f'{path} is {original.width}x{original.height}')
+        original.draft('RGB', (largest, largest))
+        original.thumbnail((largest, largest), Image.LANCZOS)
+        return ImageOps.exif_transpose(original), original.format
+
+
+def make_thumbnail(folder, filename):
+    # Decodes the upload once and writes every variant as WebP and JPEG,
+    # largest first. Nothing is copied from the original's metadata; EXIF
+    # orientation is applied to the pixels instead. The file under the
+    # upload's own name is written last, since its existence is what ends
+    # the placeholder.
+    source = upload_path(folder, filename)
+    image, original_format = decode(source, max(VARIANTS[folder]))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    opaque = image
+    if image.mode == 'RGBA':
+        opaque = Image.new('RGB', image.size, 'white')
+        opaque.paste(image, mask=image.getchannel('A'))
+    for width in sorted(VARIANTS[folder], reverse=True):
+        variant = image.copy()
+        variant.thumbnail((width, width), Image.LANCZOS)
+        save_atomic(variant, static_path(folder, variant_name(filename, width, 'webp')), **WEBP_OPTIONS)
+        variant = opaque.copy()
+        variant.thumbnail((width, width), Image.LANCZOS)
+        save_atomic(variant, static_path(folder, variant_name(filename, width, 'jpg')), **JPEG_OPTIONS)
+    base = (opaque if original_format == 'JPEG' else image).copy()
+    base.thumbnail(OUTPUT_SIZE, Image.LANCZOS)
+    save_atomic(base, static_path(folder, filename), format=original_format)
+    os.remove(source)
+
+
+class ThumbnailPool:
+    # Uploads are written to instance/uploads/ as they arrive and resized
+    # by THUMBNAIL_WORKERS background threads (Pillow releases the GIL
+    # while decoding and resizing). At most THUMBNAIL_QUEUE jobs wait; past
+    # that the request does its own thumbnail, so a burst of uploads slows
+    # down instead of piling up in memory.
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.depth = 0
+        self.executor = None
+
+    def start(self):
+        with self.start_lock:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='thumbnail')
+            # Uploads left over from a previous run.
+            for folder in PLACEHOLDERS:
+                directory = os.path.dirname(upload_path(folder, ''))
+                if os.path.isdir(directory):
+                    for filename in os.listdir(directory):
+                        self.submit(folder, filename)
+
+    def submit(self, folder, filename):
+        queued = time.monotonic()
+        if not self.slots.acquire(blocking=False):
+            metrics.inc('thumbnail.inline')
+            self.run(folder, filename, queued)
+            return
+        with self.lock:
+            self.depth += 1
+            metrics.set('thumbnail.queue_depth', self.depth)
+        self.executor.submit(self.run_queued, folder, filename, queued)
+
+    def run_queued(self, folder, filename, queued):
+        with self.lock:
+            self.depth -= 1
+            metrics.set('thumbnail.queue_depth', self.depth)
+        try:
+            self.run(folder, filename, queued)
+        finally:
+            self.slots.release()
+
+    def run(self, folder, filename, queued):
+        # Every worker process queues the leftovers it finds on start, so
+        # the same upload can be submitted by several of them. Whoever holds
+        # the flock on the source does the job; the lock goes away with a
+        # process that dies mid-job, so its upload is picked up again.
+        started = time.monotonic()
+        try:
+            source = open(upload_path(folder, filename), 'rb')
+        except FileNotFoundError:
+            return
+        with source:
+            try:
+                fcntl.flock(source, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            if os.fstat(source.fileno()).st_nlink == 0:
+                # Finished by another worker while this one waited to open it.
+                return
+            try:
+                make_thumbnail(folder, filename)
+            except Exception:
+                app.logger.exception('Thumbnail for %s/%s failed', folder, filename)
+                metrics.inc('thumbnail.failures')
+                fall_back(folder, filename)
+                return
+        done = time.monotonic()
+        metrics.observe('thumbnail.wait', started - queued)
+        metrics.observe('thumbnail.processing', done - started)
+
+
+def fall_back(folder, filename):
+    # An upload that cannot be thumbnailed becomes the placeholder: rows
+    # already naming it are pointed back at the placeholder, and a copy of
+    # the placeholder is stored under its name for a row committed after
+    # this. The source goes, since trying it again would fail the same way.
+    table = next(table for table, name in REFERENCES.items() if name == folder)
+    try:
+        path = static_path(folder, filename)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(static_path(folder, PLACEHOLDERS[folder]), tmp)
+        os.replace(tmp, path)
+        with app.app_context():
+            db.session.execute(db.text(f'UPDATE {table} SET image_file = :placeholder WHERE image_file = :name'),
+                               {'placeholder': PLACEHOLDERS[folder], 'name': filename})
+            db.session.commit()
+    except Exception:
+        app.logger.exception('Falling back to the placeholder for %s/%s failed', folder, filename)
+        return
+    os.remove(upload_path(folder, filename))
+
+
+thumbnails = ThumbnailPool(app.config['THUMBNAIL_WORKERS'], app.config['THUMBNAIL_QUEUE'])
+# Pillow's own decompression-bomb check, for anything that opens images
+# outside decode().
+Image.MAX_IMAGE_PIXELS = app.config['IMAGE_MAX_PIXELS']
+
+
+def refresh(folder, filename):
+    # Restarts the collector's grace period for a stored upload and its
+    # variants, as if it had just been uploaded, so a re-upload of an
+    # orphaned file is not collected before its row is committed. False if
+    # the upload is not stored.
+    try:
+        os.utime(static_path(folder, filename))
+    except FileNotFoundError:
+        return False
+    for width in VARIANTS[folder]:
+        for ext in ('webp', 'jpg'):
+            try:
+                os.utime(static_path(folder, variant_name(filename, width, ext)))
+            except FileNotFoundError:
+                pass
+    return True
+
+
+def save_upload(form_picture, folder):
+    # Uploads are named by the hash of their bytes, so a picture that is
+    # already stored (or still being thumbnailed) is reused as is: no
+    # decode, no encode, and the copy just hashed is thrown away.
+    _, f_ext = os.path.splitext(form_picture.filename)
+    f_ext = {'.jpeg': '.jpg'}.get(f_ext.lower(), f_ext.lower())
+    thumbnails.start()
+    incoming = os.path.join(app.instance_path, 'uploads', 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=incoming, delete=False) as f:
+        for chunk in iter(lambda: form_picture.stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    filename = digest.hexdigest()[:32] + f_ext
+    path = upload_path(folder, filename)
+    if refresh(folder, filename) or os.path.exists(path):
+        os.remove(f.name)
+        metrics.inc('uploads.deduplicated')
+        return filename
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(f.name, path)
+    thumbnails.submit(folder, filename)
+    return filename
+
+
+# Triggers keep image_ref.refs equal to the number of users and games
+# pointing at each stored file ('<folder>/<filename>'), so the collector
+# can tell what is safe to delete without scanning both tables.
+REFERENCES = {'user': 'profile_pics', 'game': 'game_cover'}
+
+
+def image_ref_ddl(table):
+    folder = REFERENCES[table]
+    add = ("INSERT INTO image_ref (name, refs) VALUES ('{folder}/' || {row}.image_file, 1)"
+           ' ON CONFLICT (name) DO UPDATE SET refs = refs + 1;')
+    drop = "UPDATE image_ref SET refs = refs - 1 WHERE name = '{folder}/' || {row}.image_file;"
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS {table}_image_ref_ai AFTER INSERT ON {table}'
+        f' WHEN new.image_file IS NOT NULL BEGIN {add.format(folder=folder, row="new")} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_image_ref_ad AFTER DELETE ON {table}'
+        f' WHEN old.image_file IS NOT NULL BEGIN {drop.format(folder=folder, row="old")} END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_image_ref_au AFTER UPDATE OF image_file ON {table}'
+        f' WHEN old.image_file IS NOT new.image_file BEGIN'
+        f' {drop.format(folder=folder, row="old")} {add.format(folder=folder, row="new")} END',
+    ]
+
+
+def create_image_refs(conn):
+    for table in REFERENCES:
+        for statement in image_ref_ddl(table):
+            conn.exec_driver_sql(statement)
+
+
+def backfill_image_refs(conn):
+    conn.exec_driver_sql('DELETE FROM image_ref')
+    for table, folder in REFERENCES.items():
+        conn.exec_driver_sql(f"INSERT INTO image_ref (name, refs) SELECT '{folder}/' || image_file, COUNT(*)"
+                             f' FROM {table} WHERE image_file IS NOT NULL GROUP BY image_file')
+
+
+def referenced_stems():
+    # One pass over image_ref's primary key instead of scanning user and
+    # game. Names are reduced to their stem so a referenced upload also
+    # keeps its size variants.
+    stems = {folder: {os.path.splitext(name)[0]} for folder, name in PLACEHOLDERS.items()}
+    for (name,) in db.session.query(ImageRef.name).filter(ImageRef.refs > 0):
+        folder, _, filename = name.partition('/')
+        stems.setdefault(folder, set()).add(os.path.splitext(filename)[0])
+    return stems
+
+
+def file_stem(filename):
+    if filename.endswith('.tmp'):
+        return None
+    match = VARIANT_NAME.match(filename)
+    return match.group(1) if match else os.path.splitext(filename)[0]
+
+
+def collect_garbage(grace, quarantine=False, dry_run=False):
+    # Removes (or moves to instance/quarantine/) files under the upload
+    # folders that no user or game refers to and that are older than
+    # grace seconds, so an upload whose row is not committed yet is never
+    # touched. Leftover .tmp files and abandoned incoming uploads go too.
+    stems = referenced_stems()
+    cutoff = time.time() - grace
+    files = reclaimed = 0
+    directories = [(folder, os.path.join(app.static_folder, folder)) for folder in PLACEHOLDERS]
+    directories.append((None, os.path.join(app.instance_path, 'uploads', 'incoming')))
+    for folder, directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                info = entry.stat()
+                if info.st_mtime > cutoff:
+                    continue
+                if folder is not None and file_stem(entry.name) in stems[folder]:
+                    continue
+                files += 1
+                reclaimed += info.st_size
+                if dry_run:
+                    continue
+                if quarantine:
+                    target = os.path.join(app.instance_path, 'quarantine', folder or 'incoming')
+                    os.makedirs(target, exist_ok=True)
+                    os.replace(entry.path, os.path.join(target, entry.name))
+                else:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+    if not dry_run:
+        metrics.inc('images.gc.files', files)
+        metrics.inc('images.gc.bytes', reclaimed)
+    return files, reclaimed
+
+
+def collect_periodically():
+    while True:
+        time.sleep(app.config['IMAGE_GC_INTERVAL'])
+        try:
+            with app.app_context():
+                files, reclaimed = collect_garbage(app.config['IMAGE_GC_GRACE'])
+            app.logger.info('Image GC removed %d files, %d bytes', files, reclaimed)
+        except Exception:
+            app.logger.exception('Image GC failed')
+
+
+if app.config['IMAGE_GC_INTERVAL']:
+    # Run this in one process per host; the CLI command suits cron.
+    threading.Thread(target=collect_periodically, name='image-gc', daemon=True).start()
+
+
+def image_error(file):
+    # Checks an uploaded file from its header alone, for form validation.
+    try:
+        with Image.open(file.stream) as image:
+            pixels = image.width * image.height
+    except (OSError, Image.DecompressionBombError):
+        return 'That file is not a picture we can read.'
+    finally:
+        file.stream.seek(0)
+    if pixels > app.config['IMAGE_MAX_PIXELS']:
+        return f"Pictures can have at most {app.config['IMAGE_MAX_PIXELS'] // 1000000} megapixels."
+    return None
+
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    flash(f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'danger')
+    return redirect(request.url)
+
+
+def pending(folder, filename):
+    # True while the upload behind filename, or behind one of its variants,
+    # is waiting for the thumbnail pool.
+    match = VARIANT_NAME.match(filename)
+    if match:
+        stem = match.group(1)
+        directory = os.path.dirname(upload_path(folder, ''))
+        return any(os.path.splitext(name)[0] == stem for name in os.listdir(directory)) \
+            if os.path.isdir(directory) else False
+    return os.path.exists(upload_path(folder, filename))
+
+
+def picture(folder, filename, size, css_class=''):
+    # <picture> with WebP and JPEG srcsets for uploads that have variants;
+    # older uploads and the default images get a plain lazy <img>.
+    attrs = Markup(' class="{}" width="{}" height="{}" loading="lazy" alt=""').format(css_class, size, size)
+    widths = VARIANTS.get(folder, ())
+    if not widths or not (os.path.exists(static_path(folder, variant_name(filename, widths[-1], 'jpg')))
+                          or pending(folder, filename)):
+        src = url_for('static', filename=f'{folder}/{filename}')
+        return Markup('<img src="{}"{}>').format(src, attrs)
+
+    def srcset(ext):
+        return ', '.join(url_for('static', filename=f'{folder}/{variant_name(filename, w, ext)}') + f' {w}w'
+                         for w in widths)
+    fallback = next((w for w in widths if w >= size), widths[-1])
+    src = url_for('static', filename=f'{folder}/{variant_name(filename, fallback, "jpg")}')
+    return Markup('<picture><source type="image/webp" srcset="{}" sizes="{}px">'
+                  '<img src="{}" srcset="{}" sizes="{}px"{}></picture>').format(
+        srcset('webp'), size, src, srcset('jpg'), size, attrs)
+
+
+app.jinja_env.globals['picture'] = picture
+
+
+@app.before_request
+def pending_thumbnail():
+    if request.endpoint != 'static':
+        return None
+    folder, _, filename = request.view_args['filename'].partition('/')
+    if folder in PLACEHOLDERS and filename and not os.path.exists(static_path(folder, filename)) \
+            and pending(folder, filename):
+        response = send_from_directory(app.static_folder, f'{folder}/{PLACEHOLDERS[folder]}')
+        response.cache_control.no_store = True
+        return response
+    return None
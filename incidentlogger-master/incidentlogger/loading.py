@@ -0,0 +1,45 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+from incidentlogger import app
+from incidentlogger.models import User
+
+
+class UnplannedLoad(Exception):
+    pass
+
+
+def with_author(model):
+    # Listing cards only show the author's name and avatar.
+    return joinedload(model.author).load_only(User.username, User.image_file)
+
+
+def with_tags(model):
+    # Write routes that re-sync tags need the current tag rows.
+    return joinedload(model.tag_list)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_lazy_loads(state):
+    # Any relationship load fired while a request is being served is one
+    # the view did not eager load, i.e. a potential N+1.
+    if not state.is_relationship_load or state.lazy_loaded_from is None:
+        return
+    if not has_request_context():
+        return
+    mode = app.config['LAZY_LOAD_DETECTION']
+    if not mode:
+        return
+    path = str(state.loader_strategy_path[-1])
+    if mode == 'raise':
+        raise UnplannedLoad(f'Unplanned relationship load of {path}')
+    g.setdefault('lazy_loads', []).append(path)
+
+
+@app.after_request
+def report_lazy_loads(response):
+    loads = g.pop('lazy_loads', None)
+    if loads:
+        app.logger.warning('%s unplanned relationship load(s) in %s: %s',
+                           len(loads), request.endpoint, ', '.join(sorted(set(loads))))
+    return response
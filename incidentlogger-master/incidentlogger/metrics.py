@@ -0,0 +1,51 @@
+import threading
+from flask import abort, jsonify, request
+from flask_login import current_user
+from incidentlogger import app
+
+
+class Metrics:
+    # Per-process counters, gauges and timings, read back from /metrics.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            count, total, peak = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + value, max(peak, value))
+
+    def snapshot(self):
+        with self.lock:
+            timings = {name: {'count': count, 'avg': total / count, 'max': peak}
+                       for name, (count, total, peak) in self.timings.items()}
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges), 'timings': timings}
+
+
+metrics = Metrics()
+
+
+@app.before_request
+def count_request():
+    metrics.inc('requests')
+
+
+@app.route("/metrics")
+def metrics_view():
+    # Only for admins, or for a scraper on the same host. Behind a reverse
+    # proxy on that host every request looks local, so leave it off there.
+    local = request.remote_addr in ('127.0.0.1', '::1')
+    if not app.config['METRICS_ENABLED'] or not (local or (current_user.is_authenticated and current_user.priv)):
+        abort(404)
+    return jsonify(metrics.snapshot())
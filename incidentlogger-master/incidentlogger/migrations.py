@@ -0,0 +1,207 @@
+import json
+import re
+from sqlalchemy import inspect
+from incidentlogger import db
+from incidentlogger.search import create_search_index, rebuild_search_index
+from incidentlogger.totals import create_counters, backfill_counters
+from incidentlogger.cache import create_version_triggers
+from incidentlogger.images import create_image_refs, backfill_image_refs
+from incidentlogger.tags import add_tag_dates, create_tag_dates, backfill_tag_dates
+from incidentlogger.models import IncidentEvent, Category, ContentVersion, ImageRef, OutboxMessage, RowCount, Tag, game_tags, incident_tags, normalize_email, parse_tags, HISTORY_SUMMARY_EVENTS
+
+
+HISTORY_LINE = re.compile(r'^\s*(Created|Updated) by (.*?)\s*$')
+
+
+def widen_image_file(conn):
+    # Stored uploads are named by a 32-character hash. SQLite cannot change
+    # a column's type, but VARCHAR(20) and VARCHAR(40) have the same
+    # affinity and the same rows on disk, so the CREATE TABLE text is edited
+    # in place (see "Making Other Kinds Of Table Schema Changes" in
+    # SQLite's ALTER TABLE documentation).
+    version = conn.exec_driver_sql('PRAGMA schema_version').scalar()
+    conn.exec_driver_sql('PRAGMA writable_schema = ON')
+    conn.exec_driver_sql("UPDATE sqlite_master SET sql = replace(sql, 'image_file VARCHAR(20)',"
+                         " 'image_file VARCHAR(40)') WHERE type = 'table' AND name IN ('user', 'game')")
+    conn.exec_driver_sql(f'PRAGMA schema_version = {version + 1}')
+    conn.exec_driver_sql('PRAGMA writable_schema = OFF')
+
+
+def backfill_incident_events(conn):
+    # Turn the old free-text history ("Created by x\n Updated by y ...") into
+    # incident_event rows and cut history down to the card summary. The old
+    # text has no times, so every event gets the incident's date_posted.
+    rows = conn.exec_driver_sql(
+        'SELECT id, date_posted, history FROM incident WHERE NOT EXISTS '
+        '(SELECT 1 FROM incident_event WHERE incident_id = incident.id)').fetchall()
+    for incident_id, date_posted, history in rows:
+        events, summary = [], []
+        for line in (history or '').split('\n'):
+            if not line.strip():
+                continue
+            match = HISTORY_LINE.match(line)
+            if match:
+                action, actor, diff = match.group(1).lower(), match.group(2), '{}'
+                summary.append(f'{match.group(1)} by {actor}')
+            else:
+                action, actor, diff = 'note', '', json.dumps({'note': line.strip()})
+                summary.append(line.strip())
+            events.append((incident_id, actor, action, date_posted, diff))
+        if events:
+            conn.exec_driver_sql(
+                'INSERT INTO incident_event (incident_id, actor, action, timestamp, diff)'
+                ' VALUES (?, ?, ?, ?, ?)', events)
+        conn.exec_driver_sql('UPDATE incident SET history = ? WHERE id = ?',
+                             ('\n'.join(summary[-HISTORY_SUMMARY_EVENTS:]), incident_id))
+
+
+def backfill_tags(conn):
+    # Index the free-text tags of existing games and incidents.
+    ids = dict(conn.exec_driver_sql('SELECT name, id FROM tag').fetchall())
+    for table, link, column, counter in (('game', 'game_tag', 'game_id', 'game_count'),
+                                         ('incident', 'incident_tag', 'incident_id', 'incident_count')):
+        for row_id, text in conn.exec_driver_sql(f'SELECT id, tags FROM {table}').fetchall():
+            for name in parse_tags(text):
+                if name not in ids:
+                    ids[name] = conn.exec_driver_sql(
+                        'INSERT INTO tag (name, game_count, incident_count) VALUES (?, 0, 0)',
+                        (name,)).lastrowid
+                conn.exec_driver_sql(
+                    f'INSERT OR IGNORE INTO {link} (tag_id, {column}) VALUES (?, ?)',
+                    (ids[name], row_id))
+        conn.exec_driver_sql(
+            f'UPDATE tag SET {counter} = (SELECT COUNT(*) FROM {link} WHERE tag_id = tag.id)')
+
+
+def add_updated_at(conn):
+    # Existing rows were last touched no later than when they were posted.
+    for table in ('post', 'game', 'incident'):
+        columns = [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')]
+        if 'updated_at' not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN updated_at DATETIME NOT NULL"
+                                 f" DEFAULT '1970-01-01 00:00:00'")
+            conn.exec_driver_sql(f'UPDATE {table} SET updated_at = COALESCE(date_posted, CURRENT_TIMESTAMP)')
+
+
+def add_email_normalized(conn):
+    # Addresses that differ only in case belong to one person; two such
+    # accounts cannot both keep theirs, so the unique index then fails and
+    # the upgrade stops for someone to merge them.
+    columns = [row[1] for row in conn.exec_driver_sql('PRAGMA table_info(user)')]
+    if 'email_normalized' not in columns:
+        conn.exec_driver_sql("ALTER TABLE user ADD COLUMN email_normalized VARCHAR(120) NOT NULL DEFAULT ''")
+    rows = conn.exec_driver_sql('SELECT id, email FROM user').fetchall()
+    conn.exec_driver_sql('UPDATE user SET email_normalized = ? WHERE id = ?',
+                         [(normalize_email(email), user_id) for user_id, email in rows])
+    conn.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email_normalized'
+                         ' ON user (email_normalized)')
+
+
+# Each entry upgrades the schema by one version. The version an existing
+# site.db is at lives in SQLite's PRAGMA user_version, so deployments are
+# upgraded in place on startup. Steps are SQL strings or callables taking a
+# connection, and must be safe to re-run.
+MIGRATIONS = [
+    # 1: indexes for the listing queries
+    [
+        'CREATE INDEX IF NOT EXISTS ix_post_user_id_date_posted ON post (user_id, date_posted)',
+        'CREATE INDEX IF NOT EXISTS ix_post_date_posted_id ON post (date_posted, id)',
+        'CREATE INDEX IF NOT EXISTS ix_game_user_id_date_posted ON game (user_id, date_posted)',
+        'CREATE INDEX IF NOT EXISTS ix_game_date_posted_id ON game (date_posted, id)',
+        'CREATE INDEX IF NOT EXISTS ix_incident_user_id_date_posted ON incident (user_id, date_posted)',
+        'CREATE INDEX IF NOT EXISTS ix_incident_date_posted_id ON incident (date_posted, id)',
+    ],
+    # 2: incident history moves to the append-only incident_event table
+    [
+        lambda conn: IncidentEvent.__table__.create(conn, checkfirst=True),
+        backfill_incident_events,
+    ],
+    # 3: normalized tags
+    [
+        lambda conn: Tag.__table__.create(conn, checkfirst=True),
+        lambda conn: game_tags.create(conn, checkfirst=True),
+        lambda conn: incident_tags.create(conn, checkfirst=True),
+        backfill_tags,
+    ],
+    # 4: persistent category registry
+    [
+        lambda conn: Category.__table__.create(conn, checkfirst=True),
+        'INSERT OR IGNORE INTO category (name) SELECT DISTINCT category FROM incident',
+        'CREATE INDEX IF NOT EXISTS ix_incident_category_date_posted ON incident (category, date_posted)',
+    ],
+    # 5: FTS5 search indexes
+    [
+        create_search_index,
+        rebuild_search_index,
+    ],
+    # 6: trigger-maintained row counters for listing totals
+    [
+        lambda conn: RowCount.__table__.create(conn, checkfirst=True),
+        create_counters,
+        backfill_counters,
+    ],
+    # 7: content versions for the page cache
+    [
+        lambda conn: ContentVersion.__table__.create(conn, checkfirst=True),
+        create_version_triggers,
+    ],
+    # 8: updated_at on posts, games and incidents
+    [
+        add_updated_at,
+    ],
+    # 9: reference counts for stored images
+    [
+        lambda conn: ImageRef.__table__.create(conn, checkfirst=True),
+        create_image_refs,
+        backfill_image_refs,
+    ],
+    # 10: case-insensitive email lookups
+    [
+        add_email_normalized,
+    ],
+    # 11: outgoing mail queue
+    [
+        lambda conn: OutboxMessage.__table__.create(conn, checkfirst=True),
+    ],
+    # 12: room for content-addressed upload names
+    [
+        widen_image_file,
+    ],
+    # 13: tag pages in index order
+    [
+        add_tag_dates,
+        create_tag_dates,
+        backfill_tag_dates,
+    ],
+]
+
+HEAD = len(MIGRATIONS)
+
+# Schema the models cannot express, run after create_all on a fresh database.
+SETUP = [create_search_index, create_counters, create_version_triggers, create_image_refs,
+         create_tag_dates]
+
+
+def current_version(conn):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def upgrade_db(engine=None):
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        version = current_version(conn)
+        if version == 0 and not inspect(conn).has_table('user'):
+            # Fresh database: the models already carry every index.
+            db.metadata.create_all(conn)
+            for step in SETUP:
+                step(conn)
+            conn.exec_driver_sql(f'PRAGMA user_version = {HEAD}')
+            return HEAD
+        for number, steps in enumerate(MIGRATIONS[version:], version + 1):
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.exec_driver_sql(step)
+            conn.exec_driver_sql(f'PRAGMA user_version = {number}')
+        return max(version, HEAD)
@@ -1,34 +1,54 @@
+import json
+import re
 from datetime import datetime
 from pytz import timezone
-from incidentlogger import db, login_manager
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import validates
+from incidentlogger import db
 from flask_login import UserMixin
 
 tz = timezone('EST')
+HISTORY_SUMMARY_EVENTS = 5
+
+def normalize_email(email):
+    return (email or '').strip().lower()
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    image_file = db.Column(db.String(20), nullable=False, default='default.jpg')    
+    # What email lookups match on; kept in step with email by set_email.
+    email_normalized = db.Column(db.String(120), nullable=False, unique=True, index=True)
+    image_file = db.Column(db.String(40), nullable=False, default='default.jpg')    
     password = db.Column(db.String(60), nullable=False)
     priv = db.Column(db.Boolean(), default = False, nullable=False)
     incidents = db.relationship('Incident', backref='author', lazy=True)
     games = db.relationship('Game', backref='author', lazy=True)
     posts = db.relationship('Post', backref='author', lazy=True)
 
-    def get_reset_token(self, expires_sec=1800):
-        s = Serializer(app.config['SECRET_KEY'], expires_sec)
-        return s.dumps({'user_id': self.id}).decode('utf-8')
+    @validates('email')
+    def set_email(self, key, email):
+        self.email_normalized = normalize_email(email)
+        return email
+
+    @staticmethod
+    def by_email(email):
+        # Every lookup by email goes through here: one probe of the
+        # email_normalized index, whatever case the user typed.
+        return User.query.filter_by(email_normalized=normalize_email(email)).first()
+
+    def get_reset_token(self):
+        s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+        return s.dumps({'user_id': self.id})
 
     @staticmethod
-    def verify_reset_token(token):
-        s = Serializer(app.config['SECRET_KEY'])
+    def verify_reset_token(token, expires_sec=1800):
+        s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
         try:
-            user_id = s.loads(token)['user_id']
+            user_id = s.loads(token, max_age=expires_sec)['user_id']
         except:
             return None
         return User.query.get(user_id)
@@ -37,7 +57,84 @@ class User(db.Model, UserMixin):
         return f"User('{self.username}', '{self.email}')"
 
 
-class Incident(db.Model):
+def parse_tags(text):
+    names = []
+    for name in re.split(r'[\s,]+', text or ''):
+        name = name.lstrip('#').lower()[:50]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+game_tags = db.Table('game_tag',
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Column('game_id', db.Integer, db.ForeignKey('game.id'), primary_key=True),
+    # The game's date_posted, kept by triggers (see tags.py).
+    db.Column('date_posted', db.DateTime),
+    db.Index('ix_game_tag_game_id', 'game_id'),
+    db.Index('ix_game_tag_tag_id_date_posted', 'tag_id', 'date_posted', 'game_id'))
+
+incident_tags = db.Table('incident_tag',
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Column('incident_id', db.Integer, db.ForeignKey('incident.id'), primary_key=True),
+    db.Column('date_posted', db.DateTime),
+    db.Index('ix_incident_tag_incident_id', 'incident_id'),
+    db.Index('ix_incident_tag_tag_id_date_posted', 'tag_id', 'date_posted', 'incident_id'))
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    game_count = db.Column(db.Integer, nullable=False, default=0)
+    incident_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"Tag('{self.name}')"
+
+
+class Tagged:
+    # Keeps the free-text tags column, the tag_list association and the
+    # per-tag counters in step. tag_count names the Tag counter to bump.
+
+    def set_tags(self, text):
+        self.tags = text
+        self.sync_tags(parse_tags(text))
+
+    def clear_tags(self):
+        self.sync_tags([])
+
+    def sync_tags(self, names):
+        counter = getattr(Tag, self.tag_count)
+        current = {tag.name: tag for tag in self.tag_list}
+        for name, tag in current.items():
+            if name not in names:
+                self.tag_list.remove(tag)
+                setattr(tag, self.tag_count, counter - 1)
+        missing = [name for name in names if name not in current]
+        if not missing:
+            return
+        with db.session.no_autoflush:
+            # Another request may be adding the same new tag; the upsert
+            # lets both end up linking to the one row.
+            db.session.execute(insert(Tag).values(
+                [{'name': name, 'game_count': 0, 'incident_count': 0} for name in missing])
+                .on_conflict_do_nothing())
+            found = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(missing))}
+        for name in missing:
+            tag = found[name]
+            setattr(tag, self.tag_count, counter + 1)
+            self.tag_list.append(tag)
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+
+    def __repr__(self):
+        return f"Category('{self.name}')"
+
+
+class Incident(db.Model, Tagged):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.String(100), nullable=False)
     title = db.Column(db.String(100), nullable=False)
@@ -47,36 +144,142 @@ class Incident(db.Model):
     contact = db.Column(db.String(100), nullable=False)
     state = db.Column(db.String(100), nullable=False)
     current_assignee = db.Column(db.String(100), nullable=False)
+    # Only the last HISTORY_SUMMARY_EVENTS lines; the full log is in events.
     history = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.current_timestamp())
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    tag_list = db.relationship('Tag', secondary=incident_tags, lazy=True)
+    tag_count = 'incident_count'
+    events = db.relationship('IncidentEvent', backref='incident', lazy='dynamic',
+                             cascade='all, delete-orphan', order_by='IncidentEvent.id.desc()')
+
+    __table_args__ = (
+        db.Index('ix_incident_user_id_date_posted', 'user_id', 'date_posted'),
+        db.Index('ix_incident_date_posted_id', 'date_posted', 'id'),
+        db.Index('ix_incident_category_date_posted', 'category', 'date_posted'),
+    )
+
+    def log_event(self, actor, action, changes=None):
+        event = IncidentEvent(actor=actor, action=action, diff=json.dumps(changes or {}))
+        self.events.append(event)
+        lines = self.history.split('\n') if self.history else []
+        lines.append(event.summary())
+        self.history = '\n'.join(lines[-HISTORY_SUMMARY_EVENTS:])
+        return event
 
     def __repr__(self):
         return f"Incident('{self.title}', '{self.date_posted}')"
 
-class Game(db.Model):
+
+class IncidentEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    incident_id = db.Column(db.Integer, db.ForeignKey('incident.id'), nullable=False)
+    actor = db.Column(db.String(100), nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    diff = db.Column(db.Text, nullable=False, default='{}')
+
+    __table_args__ = (
+        db.Index('ix_incident_event_incident_id_id', 'incident_id', 'id'),
+    )
+
+    @property
+    def changes(self):
+        return json.loads(self.diff)
+
+    def summary(self):
+        if self.action == 'note':
+            return self.changes.get('note', '')
+        return f"{self.action.capitalize()} by {self.actor}"
+
+    def __repr__(self):
+        return f"IncidentEvent('{self.action}', '{self.actor}', '{self.timestamp}')"
+
+class Game(db.Model, Tagged):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
-    image_file = db.Column(db.String(20), nullable=True, default='yay.jpg')
+    image_file = db.Column(db.String(40), nullable=True, default='yay.jpg')
     rank = db.Column(db.Integer, nullable = True)
     system = db.Column(db.String(100), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=True, default=datetime.now(tz))
     date_released = db.Column(db.DateTime, nullable=True, default=datetime.now(tz))
     descript = db.Column(db.Text, nullable=False)
     tags = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.current_timestamp())
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    tag_list = db.relationship('Tag', secondary=game_tags, lazy=True)
+    tag_count = 'game_count'
 
+    __table_args__ = (
+        db.Index('ix_game_user_id_date_posted', 'user_id', 'date_posted'),
+        db.Index('ix_game_date_posted_id', 'date_posted', 'id'),
+    )
 
     def __repr__(self):
     	return f"Game('{self.title}', '{self.system}')"
 
 
+class RowCount(db.Model):
+    name = db.Column(db.String(150), primary_key=True)
+    n = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"RowCount('{self.name}', {self.n})"
+
+
+class ImageRef(db.Model):
+    name = db.Column(db.String(150), primary_key=True)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ImageRef('{self.name}', {self.refs})"
+
+
+class OutboxMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    sender = db.Column(db.String(120), nullable=False)
+    recipients = db.Column(db.Text, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # When the sender should next try; NULL once sent or given up on.
+    next_attempt_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_outbox_message_next_attempt_at', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f"OutboxMessage('{self.subject}', '{self.recipients}', {self.attempts})"
+
+
+class ContentVersion(db.Model):
+    name = db.Column(db.String(20), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ContentVersion('{self.name}', {self.version})"
+
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
     rank = db.Column(db.Integer, nullable = True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.current_timestamp())
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_post_user_id_date_posted', 'user_id', 'date_posted'),
+        db.Index('ix_post_date_posted_id', 'date_posted', 'id'),
+    )
+
     def __repr__(self):
         return f"Post('{self.title}', '{self.date_posted}')"
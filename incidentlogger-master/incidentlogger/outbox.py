@@ -0,0 +1,144 @@
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from flask_mail import Message
+from sqlalchemy import select, update
+from incidentlogger import app, db, mail
+from incidentlogger.metrics import metrics
+from incidentlogger.models import OutboxMessage
+
+
+def enqueue(subject, recipients, body, sender=None):
+    # Adds the message to the caller's transaction; it goes out once that
+    # commits and the sender next wakes up (call sender.wake() after commit).
+    message = OutboxMessage(subject=subject,
+                            sender=sender or app.config['MAIL_DEFAULT_SENDER'],
+                            recipients=','.join(recipients),
+                            body=body)
+    db.session.add(message)
+    return message
+
+
+def claim(limit):
+    # Leases up to limit due messages by pushing their next attempt past
+    # MAIL_LEASE, so other workers skip them while this one sends. A sender
+    # that dies mid-batch just lets the lease run out.
+    now = datetime.utcnow()
+    due = select(OutboxMessage.id)\
+        .where(OutboxMessage.next_attempt_at <= now)\
+        .order_by(OutboxMessage.next_attempt_at)\
+        .limit(limit)
+    ids = db.session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(due))
+        .values(next_attempt_at=now + timedelta(seconds=app.config['MAIL_LEASE']))
+        .returning(OutboxMessage.id)).scalars().all()
+    db.session.commit()
+    if not ids:
+        return []
+    return OutboxMessage.query.filter(OutboxMessage.id.in_(ids)).order_by(OutboxMessage.id).all()
+
+
+def retry(message, error):
+    message.attempts += 1
+    message.last_error = str(error)[:1000]
+    if message.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        message.next_attempt_at = None
+        metrics.inc('mail.failed')
+        app.logger.error('Giving up on mail %d to %s: %s', message.id, message.recipients, error)
+        return
+    backoff = app.config['MAIL_RETRY_BACKOFF'] * 2 ** (message.attempts - 1)
+    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+    metrics.inc('mail.retried')
+
+
+def send_batch():
+    # Sends one batch of due messages over a single SMTP connection and
+    # returns how many were claimed. A message the server refuses is retried
+    # on its own; losing the connection retries the rest of the batch.
+    messages = claim(app.config['MAIL_BATCH_SIZE'])
+    if not messages:
+        return 0
+    started = time.monotonic()
+    remaining = list(messages)
+    try:
+        with mail.connect() as connection:
+            while remaining:
+                message = remaining[0]
+                try:
+                    connection.send(Message(message.subject,
+                                            sender=message.sender,
+                                            recipients=message.recipients.split(','),
+                                            body=message.body))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError) as error:
+                    retry(message, error)
+                else:
+                    message.sent_at = datetime.utcnow()
+                    message.next_attempt_at = None
+                    message.last_error = None
+                    metrics.inc('mail.sent')
+                    metrics.observe('mail.delay', (message.sent_at - message.created_at).total_seconds())
+                remaining.pop(0)
+    except (OSError, smtplib.SMTPException) as error:
+        for message in remaining:
+            retry(message, error)
+    db.session.commit()
+    metrics.observe('mail.batch', time.monotonic() - started)
+    return len(messages)
+
+
+def flush():
+    # Sends everything that is due now. Messages that fail are rescheduled,
+    # so this always finishes.
+    total = 0
+    while True:
+        sent = send_batch()
+        total += sent
+        if sent < app.config['MAIL_BATCH_SIZE']:
+            return total
+
+
+class OutboxSender:
+    # One background thread per process drains the outbox: woken right
+    # after a message is enqueued, and otherwise every MAIL_POLL_INTERVAL
+    # seconds to pick up retries and mail queued by other workers.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            # A thread does not survive fork, so each worker starts its own.
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.loop, name='mail-outbox', daemon=True).start()
+
+    def wake(self):
+        if app.config['MAIL_OUTBOX_SENDER']:
+            self.start()
+            self.event.set()
+
+    def loop(self):
+        while True:
+            self.event.wait(app.config['MAIL_POLL_INTERVAL'])
+            self.event.clear()
+            try:
+                with app.app_context():
+                    flush()
+            except Exception:
+                app.logger.exception('Mail outbox failed')
+
+
+sender = OutboxSender()
+
+
+@app.before_request
+def start_sender():
+    if app.config['MAIL_OUTBOX_SENDER']:
+        sender.start()
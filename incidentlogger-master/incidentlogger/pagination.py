@@ -0,0 +1,98 @@
+import base64
+import json
+from datetime import datetime
+from flask import abort, request
+from sqlalchemy import tuple_
+
+
+def encode_cursor(direction, date_posted, row_id):
+    raw = json.dumps([direction, date_posted.isoformat(), row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, date_posted, row_id = json.loads(raw.decode('utf-8'))
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, datetime.fromisoformat(date_posted), int(row_id)
+    except (ValueError, TypeError):
+        abort(400)
+
+
+class KeysetPage:
+    # Seek pagination over (date_posted, id), newest first. Only the rows of
+    # the page are fetched (plus one to know if there is more), so page
+    # 10,000 costs the same as page 1 and no COUNT(*) is needed. order
+    # names the two columns to seek on when they are not the model's own,
+    # e.g. copies of them in a joined table with a better index.
+
+    def __init__(self, query, model, cursor=None, per_page=5, total=None, order=None):
+        self.query = query
+        self.model = model
+        self.per_page = per_page
+        self.count = total
+        date_posted, row_id = order or (model.date_posted, model.id)
+        key = tuple_(date_posted, row_id)
+
+        direction = None
+        if cursor:
+            direction, seek_date, seek_id = decode_cursor(cursor)
+            seek = tuple_(seek_date, seek_id)
+
+        if direction == 'prev':
+            rows = query.filter(key > seek)\
+                .order_by(date_posted.asc(), row_id.asc())\
+                .limit(per_page + 1).all()
+            more = len(rows) > per_page
+            self.items = rows[:per_page][::-1]
+            self.has_prev = more
+            self.has_next = True
+        else:
+            if direction == 'next':
+                query = query.filter(key < seek)
+            rows = query.order_by(date_posted.desc(), row_id.desc())\
+                .limit(per_page + 1).all()
+            self.items = rows[:per_page]
+            self.has_next = len(rows) > per_page
+            self.has_prev = direction == 'next'
+
+        self.has_next = self.has_next and bool(self.items)
+        self.has_prev = self.has_prev and bool(self.items)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next:
+            return None
+        last = self.items[-1]
+        return encode_cursor('next', last.date_posted, last.id)
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev:
+            return None
+        first = self.items[0]
+        return encode_cursor('prev', first.date_posted, first.id)
+
+    @property
+    def total(self):
+        if self.count is not None:
+            return self.count()
+        return self.query.order_by(None).count()
+
+
+def paginate_listing(query, model, total=None, per_page=5, order=None):
+    # An explicit ?page=N keeps the old numbered pages working; everything
+    # else is served by cursor. total, if given, is a callable returning the
+    # row count so neither mode has to run COUNT(*).
+    page = request.args.get('page', type=int)
+    if page is not None:
+        date_posted, row_id = order or (model.date_posted, model.id)
+        ordered = query.order_by(date_posted.desc(), row_id.desc())
+        if total is None:
+            return ordered.paginate(page=page, per_page=per_page)
+        posts = ordered.paginate(page=page, per_page=per_page, count=False)
+        posts.total = total()
+        return posts
+    return KeysetPage(query, model, request.args.get('cursor'), per_page, total, order)
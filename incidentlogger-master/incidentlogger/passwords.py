@@ -0,0 +1,49 @@
+import threading
+import time
+import bcrypt
+from flask import abort
+from incidentlogger import app
+from incidentlogger.metrics import metrics
+
+
+class PasswordHasher:
+    # bcrypt releases the GIL while it works, so hashing runs in the request
+    # thread itself; PASSWORD_WORKERS caps how many hashes a process runs at
+    # once. A burst of logins then costs that many cores and nothing else:
+    # other request threads wait for a free slot (up to PASSWORD_WAIT
+    # seconds, then 503) and page views keep being served meanwhile.
+
+    def __init__(self, config):
+        self.config = config
+        self.slots = threading.BoundedSemaphore(max(config['PASSWORD_WORKERS'], 1))
+
+    def run(self, name, fn, *args):
+        queued = time.monotonic()
+        if not self.slots.acquire(timeout=self.config['PASSWORD_WAIT']):
+            metrics.inc('password.rejected')
+            abort(503)
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        finally:
+            self.slots.release()
+        metrics.observe('password.queue_wait', started - queued)
+        metrics.observe(f'password.{name}', time.monotonic() - started)
+        return result
+
+    def hash(self, password):
+        salt = bcrypt.gensalt(self.config['BCRYPT_LOG_ROUNDS'])
+        return self.run('hash', bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def check(self, hashed, password):
+        return self.run('check', bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        # '$2b$12$...': the cost the hash was made with.
+        try:
+            return int(hashed.split('$')[2]) != self.config['BCRYPT_LOG_ROUNDS']
+        except (IndexError, ValueError):
+            return True
+
+
+passwords = PasswordHasher(app.config)
@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from math import ceil
+from flask import request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from incidentlogger import app
+from incidentlogger.metrics import metrics
+from incidentlogger.models import normalize_email
+
+
+# Token buckets per endpoint, applied to POSTs: (key, burst, seconds)
+# allows `burst` requests at once, refilled evenly over `seconds`. 'ip'
+# keys on the client address, 'account' on the logged-in user or, before
+# login, the email being tried. Entries in app.config['RATE_LIMITS']
+# replace these per endpoint.
+LIMITS = {
+    'login': [('ip', 20, 60), ('account', 5, 60)],
+    'register': [('ip', 5, 3600)],
+    'reset_request': [('ip', 5, 3600), ('account', 3, 3600)],
+    'reset_token': [('ip', 10, 3600)],
+    'incident': [('ip', 30, 60), ('account', 10, 60)],
+    'game': [('ip', 30, 60), ('account', 10, 60)],
+    'new_post': [('ip', 30, 60), ('account', 10, 60)],
+    'incident_update': [('account', 30, 60)],
+    'game_update': [('account', 30, 60)],
+    'update_post': [('account', 30, 60)],
+    'incident_delete': [('account', 30, 60)],
+    'game_delete': [('account', 30, 60)],
+    'delete_post': [('account', 30, 60)],
+    'account': [('account', 10, 60)],
+}
+
+
+def refill(tokens, stamp, now, burst, seconds):
+    # Returns the bucket after taking one token, and how long to wait if
+    # there was none to take.
+    tokens = min(burst, tokens + (now - stamp) * burst / seconds)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * seconds / burst
+
+
+class MemoryBuckets:
+    # Per process, at most RATE_LIMIT_SIZE buckets; the least recently
+    # used is dropped first, which only ever errs towards letting a
+    # request through.
+
+    def __init__(self, config):
+        self.size = config['RATE_LIMIT_SIZE']
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, burst, seconds):
+        now = time.monotonic()
+        with self.lock:
+            tokens, stamp = self.buckets.pop(key, (burst, now))
+            tokens, wait = refill(tokens, stamp, now, burst, seconds)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteBuckets:
+    # Shared by every worker on the host through a small SQLite file, so
+    # limits hold across processes. Each take is one primary-key probe and
+    # one write; buckets idle for a day are pruned now and then.
+
+    def __init__(self, config):
+        self.path = config['RATE_LIMIT_PATH'] or os.path.join(app.instance_path, 'ratelimit.db')
+        self.local = threading.local()
+        self.takes = 0
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = wal')
+            conn.execute('PRAGMA synchronous = normal')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket'
+                         ' (key TEXT PRIMARY KEY, tokens REAL, stamp REAL) WITHOUT ROWID')
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, burst, seconds):
+        conn = self.connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, stamp FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = refill(*(row or (burst, now)), now, burst, seconds)
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, stamp) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            self.takes += 1
+            if self.takes % 1000 == 0:
+                conn.execute('DELETE FROM bucket WHERE stamp < ?', (now - 86400,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+BACKENDS = {'memory': MemoryBuckets, 'sqlite': SQLiteBuckets}
+
+buckets = BACKENDS[app.config['RATE_LIMIT_BACKEND']](app.config) if app.config['RATE_LIMIT_BACKEND'] else None
+
+
+def limit_key(kind):
+    if kind == 'ip':
+        return request.remote_addr or ''
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return 'email:' + normalize_email(request.form.get('email'))
+
+
+@app.before_request
+def rate_limit():
+    if buckets is None or request.method != 'POST':
+        return
+    rules = app.config['RATE_LIMITS'].get(request.endpoint, LIMITS.get(request.endpoint))
+    if not rules:
+        return
+    wait = max(buckets.take(f'{request.endpoint}|{kind}|{limit_key(kind)}', burst, seconds)
+               for kind, burst, seconds in rules)
+    if wait:
+        metrics.inc(f'ratelimit.limited.{request.endpoint}')
+        raise TooManyRequests(retry_after=ceil(wait))
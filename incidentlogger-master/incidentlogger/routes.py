@@ -1,37 +1,71 @@
-import os
-import secrets
-from PIL import Image
-from flask import render_template, url_for, flash, redirect, request,abort
-from incidentlogger import app, db, bcrypt
+from flask import render_template, url_for, flash, redirect, request,abort, jsonify
+from incidentlogger import app, db
 from incidentlogger.forms import RegistrationForm, LoginForm, IncidentForm, GameForm, UpdateAccountForm, RequestResetForm, ResetPasswordForm, PostForm
-from incidentlogger.models import User, Incident, Game, Post
+from incidentlogger.models import User, Incident, Game, Post, Tag, game_tags, incident_tags, parse_tags
+from incidentlogger.pagination import paginate_listing
+from incidentlogger.loading import with_author, with_tags
+from incidentlogger.categories import categories
+from incidentlogger.search import search, INDEXES
+from incidentlogger.totals import row_total
+from incidentlogger.cache import cached_page
+from incidentlogger.conditional import revalidate
+from incidentlogger.users import user_cache
+from incidentlogger.images import save_upload
+from incidentlogger.passwords import passwords
+from incidentlogger.outbox import enqueue, sender
 from flask_login import login_user, current_user, logout_user, login_required
-from flask_mail import Message
 
 
 systems = ['PS4', 'XBOX1', 'Switch']
-categories = []
 
 @app.route("/")
 @app.route("/home")
+@cached_page('post', 'user')
 def home():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
+    posts = paginate_listing(Post.query.options(with_author(Post)), Post,
+                             lambda: row_total('post'))
     return render_template('home.html', posts=posts)
 
 @app.route("/ghome")
+@cached_page('game', 'user')
 def ghome():
-    page = request.args.get('page', 1, type=int)
-    posts = Game.query.order_by(Game.date_posted.desc()).paginate(page=page, per_page=5)
+    posts = paginate_listing(Game.query.options(with_author(Game)), Game,
+                             lambda: row_total('game'))
     return render_template('ghome.html', posts=posts)
 
 
 @app.route("/blhome")
+@cached_page('post', 'user')
 def blhome():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
+    posts = paginate_listing(Post.query.options(with_author(Post)), Post,
+                             lambda: row_total('post'))
     return render_template('blhome.html', posts=posts)    
 
+def search_args():
+    q = request.args.get('q', '')
+    kind = request.args.get('type')
+    tables = [kind] if kind in INDEXES else None
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    return q, search(q, tables, limit)
+
+def result_url(result):
+    if result['type'] == 'incident':
+        return url_for('incident_post', incident_id=result['id'])
+    if result['type'] == 'game':
+        return url_for('game_post', game_id=result['id'])
+    return url_for('post', post_id=result['id'])
+
+@app.route("/search")
+def search_page():
+    q, results = search_args()
+    return render_template('search.html', title='Search', q=q, results=results, result_url=result_url)
+
+@app.route("/search.json")
+def search_json():
+    q, results = search_args()
+    return jsonify(query=q, results=[dict(r, snippet=str(r['snippet']), url=result_url(r))
+                                     for r in results])
+
 @app.route("/about")
 def about():
     return render_template('about.html', title='About')
@@ -43,7 +77,7 @@ def register():
         return redirect(url_for('home'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = passwords.hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data.lower(), password=hashed_password, priv=form.admin.data)
         db.session.add(user)
         db.session.commit()
@@ -58,8 +92,11 @@ def login():
         return redirect(url_for('home'))
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        user = User.by_email(form.email.data)
+        if user and passwords.check(user.password, form.password.data):
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.hash(form.password.data)
+                db.session.commit()
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('home'))
@@ -74,10 +111,11 @@ def game():
         abort(403)
     form = GameForm()
     if form.validate_on_submit():
+        post = Game(system= form.system.data,title=form.title.data, descript=form.descript.data , rank=form.rank.data, date_released=form.date_released.data, author=current_user)
         if form.picture.data:
             picture_file = save_game_pic(form.picture.data)
             post.image_file = picture_file
-        post = Game(system= form.system.data,title=form.title.data, descript=form.descript.data ,tags=form.tags.data, rank=form.rank.data, date_released=form.date_released.data, author=current_user, image_file = form.picture.data  )
+        post.set_tags(form.tags.data)
         db.session.add(post)
         db.session.commit()
         flash('Your game has been posted!', 'success')
@@ -87,19 +125,21 @@ def game():
 
 @app.route("/game/<int:game_id>")
 def game_post(game_id):
-    post = Game.query.get_or_404(game_id)
-    form = GameForm()
     if current_user.priv != True:
         abort(403)
-    image_file = url_for('static', filename='game_cover/' + post.image_file)
-    return render_template('game_post.html', image_file = image_file, title= post.title, form=form,post=post)
+    not_modified = revalidate(Game, game_id)
+    if not_modified:
+        return not_modified
+    post = Game.query.options(with_author(Game)).get_or_404(game_id)
+    form = GameForm()
+    return render_template('game_post.html', title= post.title, form=form,post=post)
 
 
 @app.route("/game/<int:game_id>/update", methods=['GET','POST'])
 @login_required
 def game_update(game_id):
-    post = Game.query.get_or_404(game_id)
-    if post.author != current_user:
+    post = Game.query.options(with_tags(Game)).get_or_404(game_id)
+    if post.user_id != current_user.id:
         abort(403)
     form = GameForm()
     if form.validate_on_submit():
@@ -109,7 +149,7 @@ def game_update(game_id):
         post.title = form.title.data
         post.descript = form.descript.data
         post.system = form.system.data
-        post.tags = form.tags.data
+        post.set_tags(form.tags.data)
         post.rank = form.rank.data
         post.date_released = form.date_released.data
         db.session.commit()
@@ -128,9 +168,10 @@ def game_update(game_id):
 @app.route("/game/<int:game_id>/delete", methods=['POST'])
 @login_required
 def game_delete(game_id):
-    post = Game.query.get_or_404(game_id)
-    if post.author != current_user:
+    post = Game.query.options(with_tags(Game)).get_or_404(game_id)
+    if post.user_id != current_user.id:
         abort(403)
+    post.clear_tags()
     db.session.delete(post)
     db.session.commit()
     flash('Your Post has been deleted', 'success')
@@ -141,39 +182,50 @@ def game_delete(game_id):
 def incident():
     form = IncidentForm()
     if form.validate_on_submit():
-        post = Incident(contact= current_user.username ,category= form.category.data,title=form.title.data, content=form.content.data, state='Inactive' ,tags=form.tags.data , current_assignee=' ' , history="Created by " + current_user.username,author=current_user)
-        if form.category.data not in  categories:
-            categories.append(form.category.data)
+        post = Incident(contact= current_user.username ,category= form.category.data,title=form.title.data, content=form.content.data, state='Inactive' ,tags=form.tags.data , current_assignee=' ' , history='',author=current_user)
+        post.set_tags(form.tags.data)
+        post.log_event(current_user.username, 'created')
         db.session.add(post)
+        categories.add(form.category.data)
         db.session.commit()
         flash('Your post has been created!', 'success')
         return redirect(url_for('home'))
     return render_template('incident.html', title='New Post',
-                           form=form, categories=categories ,legend='New Post')
+                           form=form, categories=categories.all() ,legend='New Post')
 
 
 @app.route("/incident/<int:incident_id>")
 def incident_post(incident_id):
-    post = Incident.query.get_or_404(incident_id)
+    not_modified = revalidate(Incident, incident_id)
+    if not_modified:
+        return not_modified
+    post = Incident.query.options(with_author(Incident)).get_or_404(incident_id)
     return render_template('incident_post.html', title= post.title, post=post)
 
+@app.route("/category/<string:category>")
+def category_posts(category):
+    query = Incident.query.options(with_author(Incident)).filter_by(category=category)
+    posts = paginate_listing(query, Incident, lambda: row_total(f'incident:category:{category}'))
+    return render_template('category_posts.html', posts=posts, category=category)
+
 @app.route("/incident/<int:incident_id>/update", methods=['GET','POST'])
 @login_required
 def incident_update(incident_id):
-    post = Incident.query.get_or_404(incident_id)
+    post = Incident.query.options(with_tags(Incident)).get_or_404(incident_id)
     #if post.author != current_user:
     #    abort(403)
     form = IncidentForm()
     if form.validate_on_submit():
-        post.title = form.title.data
-        post.content = form.content.data
-        post.category = form.category.data
-        post.tags = form.tags.data
-        post.history = post.history + '\n Updated by ' + current_user.username
-        post.state = 'Active'
-        post.current_assignee = current_user.username
-        if form.category.data not in  categories:
-            categories.append(form.category.data)
+        updates = {'title': form.title.data, 'content': form.content.data,
+                   'category': form.category.data, 'tags': form.tags.data,
+                   'state': 'Active', 'current_assignee': current_user.username}
+        changes = {field: [getattr(post, field), value] for field, value in updates.items()
+                   if getattr(post, field) != value}
+        for field, value in updates.items():
+            setattr(post, field, value)
+        post.set_tags(form.tags.data)
+        post.log_event(current_user.username, 'updated', changes)
+        categories.add(form.category.data)
         db.session.commit()
         flash('Your Post has been updated', 'success')
         return redirect(url_for('incident_post', incident_id = post.id))
@@ -189,9 +241,10 @@ def incident_update(incident_id):
 @app.route("/incident/<int:incident_id>/delete", methods=['POST'])
 @login_required
 def incident_delete(incident_id):
-    post = Incident.query.get_or_404(incident_id)
-    if post.author != current_user:
+    post = Incident.query.options(with_tags(Incident)).get_or_404(incident_id)
+    if post.user_id != current_user.id:
         abort(403)
+    post.clear_tags()
     db.session.delete(post)
     db.session.commit()
     flash('Your Post has been deleted', 'success')
@@ -214,7 +267,10 @@ def new_post():
 
 @app.route("/post/<int:post_id>")
 def post(post_id):
-    post = Post.query.get_or_404(post_id)
+    not_modified = revalidate(Post, post_id)
+    if not_modified:
+        return not_modified
+    post = Post.query.options(with_author(Post)).get_or_404(post_id)
     return render_template('post.html', title=post.title, post=post)
 
 
@@ -222,7 +278,7 @@ def post(post_id):
 @login_required
 def update_post(post_id):
     post = Post.query.get_or_404(post_id)
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)
     form = PostForm()
     if form.validate_on_submit():
@@ -242,7 +298,7 @@ def update_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)
     db.session.delete(post)
     db.session.commit()
@@ -252,13 +308,36 @@ def delete_post(post_id):
 
 @app.route("/user/post/<string:username>")
 def user_posts(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(author=user)\
-        .order_by(Post.date_posted.desc())\
-        .paginate(page=page, per_page=5)
+    posts = paginate_listing(Post.query.options(with_author(Post)).filter_by(author=user), Post,
+                             lambda: row_total(f'post:user:{user.id}'))
     return render_template('user_posts.html', posts=posts, user=user)
 
+@app.route("/tag/<string:name>")
+def tag_games(name):
+    tag = Tag.query.filter_by(name=name.lower()).first_or_404()
+    query = Game.query.options(with_author(Game))\
+        .join(game_tags, game_tags.c.game_id == Game.id)\
+        .filter(game_tags.c.tag_id == tag.id)
+    posts = paginate_listing(query, Game, lambda: tag.game_count,
+                             order=(game_tags.c.date_posted, game_tags.c.game_id))
+    return render_template('tag_games.html', posts=posts, tag=tag)
+
+
+@app.route("/tag/<string:name>/incidents")
+def tag_incidents(name):
+    tag = Tag.query.filter_by(name=name.lower()).first_or_404()
+    query = Incident.query.options(with_author(Incident))\
+        .join(incident_tags, incident_tags.c.incident_id == Incident.id)\
+        .filter(incident_tags.c.tag_id == tag.id)
+    posts = paginate_listing(query, Incident, lambda: tag.incident_count,
+                             order=(incident_tags.c.date_posted, incident_tags.c.incident_id))
+    return render_template('tag_incidents.html', posts=posts, tag=tag)
+
+
+app.add_template_filter(parse_tags)
+
+
 @app.route("/logout")
 def logout():
     logout_user()
@@ -266,30 +345,10 @@ def logout():
 
 
 def save_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/profile_pics', picture_fn)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+    return save_upload(form_picture, 'profile_pics')
 
 def save_game_pic(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/game_cover', picture_fn)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+    return save_upload(form_picture, 'game_cover')
 
 @app.route("/account", methods=['GET', 'POST'])
 @login_required
@@ -302,36 +361,30 @@ def account():
         current_user.username = form.username.data
         current_user.email = form.email.data
         db.session.commit()
+        user_cache.invalidate(current_user.id)
         flash('Your account has been updated!','success')
         return redirect(url_for('account'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
-    return render_template('account.html', title='Account', image_file=image_file, form=form)
+    return render_template('account.html', title='Account', form=form)
 
 
 @app.route("/user/game/<string:username>")
 def user_games(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Game.query.filter_by(author=user)\
-    .order_by(Game.date_posted.desc())\
-    .paginate(page=page, per_page=5)
+    posts = paginate_listing(Game.query.options(with_author(Game)).filter_by(author=user), Game,
+                             lambda: row_total(f'game:user:{user.id}'))
     return render_template('contact_posts.html', posts=posts, user=username)
 
 
 def send_reset_email(user):
     token = user.get_reset_token()
-    msg = Message('Password Reset Request',
-                  sender='noreply@demo.com',
-                  recipients=[user.email])
-    msg.body = f'''To reset your password, visit the following link:
+    enqueue('Password Reset Request', [user.email], f'''To reset your password, visit the following link:
 {url_for('reset_token', token=token, _external=True)}
 
 If you did not make this request then simply ignore this email and no changes will be made.
-'''
-    mail.send(msg)
+''')
 
 
 @app.route("/reset_password", methods=['GET', 'POST'])
@@ -340,8 +393,10 @@ def reset_request():
         return redirect(url_for('home'))
     form = RequestResetForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.by_email(form.email.data)
         send_reset_email(user)
+        db.session.commit()
+        sender.wake()
         flash('An email has been sent with instructions to reset your password.', 'info')
         return redirect(url_for('login'))
     return render_template('reset_request.html', title='Reset Password', form=form)
@@ -357,9 +412,10 @@ def reset_token(token):
         return redirect(url_for('reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = passwords.hash(form.password.data)
         user.password = hashed_password
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('Your password has been updated! You are now able to log in', 'success')
         return redirect(url_for('login'))
     return render_template('reset_token.html', title='Reset Password', form=form)
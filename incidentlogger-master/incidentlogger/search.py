@@ -0,0 +1,82 @@
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import text
+from incidentlogger import db
+
+
+# FTS5 indexes kept in sync with their tables by triggers. Columns are
+# listed with their bm25 weight, so a hit in the title outranks one in the
+# body.
+INDEXES = {
+    'incident': [('title', 10.0), ('content', 1.0), ('tags', 5.0)],
+    'game': [('title', 10.0), ('descript', 1.0), ('tags', 5.0)],
+    'post': [('title', 10.0), ('content', 1.0)],
+}
+
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03'
+
+
+def index_ddl(table):
+    columns = [name for name, _ in INDEXES[table]]
+    cols = ', '.join(columns)
+    new = ', '.join('new.' + c for c in columns)
+    old = ', '.join('old.' + c for c in columns)
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}',"
+        f" content_rowid='id', tokenize='porter unicode61')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN'
+        f' INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN'
+        f" INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN'
+        f" INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old});"
+        f' INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END',
+    ]
+
+
+def create_search_index(conn):
+    for table in INDEXES:
+        for statement in index_ddl(table):
+            conn.exec_driver_sql(statement)
+
+
+def rebuild_search_index(conn):
+    for table in INDEXES:
+        conn.exec_driver_sql(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+
+def match_expression(q):
+    # Quote every term so user input is never parsed as FTS5 syntax; the
+    # last term is a prefix match so results show up while typing.
+    terms = [t.replace('"', '""') for t in re.findall(r'\S+', q or '')]
+    if not terms:
+        return None
+    return ' '.join(f'"{t}"' for t in terms[:-1]) + f' "{terms[-1]}"*'
+
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace(HIGHLIGHT_START, '<mark>')
+                  .replace(HIGHLIGHT_END, '</mark>'))
+
+
+def search(q, tables=None, limit=20):
+    expression = match_expression(q)
+    if expression is None:
+        return []
+    results = []
+    for table in tables or INDEXES:
+        fts = f'{table}_fts'
+        weights = ', '.join(str(w) for _, w in INDEXES[table])
+        rows = db.session.execute(text(
+            f'SELECT {table}.id, {table}.title,'
+            f" snippet({fts}, -1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '...', 12),"
+            f' bm25({fts}, {weights}) AS score'
+            f' FROM {fts} JOIN {table} ON {table}.id = {fts}.rowid'
+            f' WHERE {fts} MATCH :q ORDER BY score LIMIT :limit'),
+            {'q': expression, 'limit': limit})
+        results += [{'type': table, 'id': row_id, 'title': title,
+                     'snippet': highlight(snippet), 'score': score}
+                    for row_id, title, snippet, score in rows]
+    # bm25 is lower-is-better; merging the three indexes by it is approximate.
+    return sorted(results, key=lambda r: r['score'])[:limit]
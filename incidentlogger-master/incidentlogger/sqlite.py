@@ -0,0 +1,102 @@
+import sqlite3
+import time
+
+
+# PRAGMAs applied to every new SQLite connection. 'default' is stock
+# SQLite (rollback journal, FULL sync); 'production' lets readers run
+# alongside a writer and waits on locks instead of failing straight away.
+PROFILES = {
+    'default': {},
+    'production': {
+        'busy_timeout': 5000,
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -20000,
+        'temp_store': 'memory',
+    },
+}
+
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+# The transaction's snapshot is older than the database; only a rollback
+# gets past it, so retrying the statement can never succeed.
+SQLITE_BUSY_SNAPSHOT = 517
+
+
+def is_busy(exc):
+    code = getattr(exc, 'sqlite_errorcode', None)
+    if code is not None:
+        return code != SQLITE_BUSY_SNAPSHOT and code & 0xff in (SQLITE_BUSY, SQLITE_LOCKED)
+    return 'locked' in str(exc) or 'busy' in str(exc)
+
+
+def with_retries(fn, retries, backoff, max_wait):
+    # busy_timeout covers most lock waits inside SQLite itself; this catches
+    # the SQLITE_BUSY it returns without waiting (a deadlock between two
+    # would-be writers, or COMMIT in rollback-journal mode) and tries again.
+    # Retries stop once max_wait seconds have gone by, so a statement
+    # blocks for at most about one busy_timeout plus max_wait.
+    started = time.monotonic()
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except sqlite3.OperationalError as exc:
+            delay = backoff * 2 ** attempt
+            if attempt == retries or not is_busy(exc) \
+                    or time.monotonic() - started + delay > max_wait:
+                raise
+            time.sleep(delay)
+
+
+def connection_factory(pragmas, retries=0, backoff=0.05, max_wait=1.0):
+    class Cursor(sqlite3.Cursor):
+        def execute(self, *args):
+            return self.retry(super().execute, args)
+
+        def executemany(self, *args):
+            return self.retry(super().executemany, args)
+
+        def retry(self, fn, args):
+            # Only a statement that opened its own transaction is retried,
+            # after rolling that transaction back. Inside a longer one the
+            # locks or snapshot of earlier statements are what is in the
+            # way, so the error goes to the caller, who must roll back.
+            if self.connection.in_transaction:
+                return fn(*args)
+
+            def attempt():
+                try:
+                    return fn(*args)
+                except sqlite3.OperationalError:
+                    if self.connection.in_transaction:
+                        self.connection.rollback()
+                    raise
+            return with_retries(attempt, retries, backoff, max_wait)
+
+    class Connection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            for name, value in pragmas.items():
+                sql = f'PRAGMA {name} = {value}'
+                with_retries(lambda: self.execute(sql), retries, backoff, max_wait)
+
+        def cursor(self, factory=Cursor):
+            return super().cursor(factory)
+
+        def commit(self):
+            # A COMMIT that returns SQLITE_BUSY leaves the transaction open,
+            # so it can be tried again as it is.
+            return with_retries(super().commit, retries, backoff, max_wait)
+
+    return Connection
+
+
+def engine_options(config):
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {}
+    factory = connection_factory(PROFILES[config['SQLITE_PROFILE']],
+                                 config['SQLITE_BUSY_RETRIES'],
+                                 config['SQLITE_BUSY_BACKOFF'],
+                                 config['SQLITE_BUSY_MAX_WAIT'])
+    return {'connect_args': {'factory': factory}}
@@ -0,0 +1,70 @@
+import time
+from incidentlogger import app, db
+from incidentlogger.models import RowCount
+
+
+# Row counters kept by triggers, so listing pages can show totals without a
+# COUNT(*). Counter names are '<table>', '<table>:user:<id>' and
+# 'incident:category:<name>'.
+COUNTED = {
+    'post': ["'post:user:' || {row}.user_id"],
+    'game': ["'game:user:' || {row}.user_id"],
+    'incident': ["'incident:user:' || {row}.user_id", "'incident:category:' || {row}.category"],
+}
+
+
+def counter_ddl(table):
+    new = [f"'{table}'"] + [key.format(row='new') for key in COUNTED[table]]
+    old = ', '.join([f"'{table}'"] + [key.format(row='old') for key in COUNTED[table]])
+    values = ', '.join(f'({name}, 1)' for name in new)
+    ddl = [
+        f'CREATE TRIGGER IF NOT EXISTS {table}_count_ai AFTER INSERT ON {table} BEGIN'
+        f' INSERT INTO row_count (name, n) VALUES {values}'
+        f' ON CONFLICT (name) DO UPDATE SET n = n + 1; END',
+        f'CREATE TRIGGER IF NOT EXISTS {table}_count_ad AFTER DELETE ON {table} BEGIN'
+        f' UPDATE row_count SET n = n - 1 WHERE name IN ({old}); END',
+    ]
+    if table == 'incident':
+        ddl.append(
+            'CREATE TRIGGER IF NOT EXISTS incident_count_au AFTER UPDATE OF category ON incident'
+            ' WHEN old.category IS NOT new.category BEGIN'
+            " UPDATE row_count SET n = n - 1 WHERE name = 'incident:category:' || old.category;"
+            " INSERT INTO row_count (name, n) VALUES ('incident:category:' || new.category, 1)"
+            ' ON CONFLICT (name) DO UPDATE SET n = n + 1; END')
+    return ddl
+
+
+def create_counters(conn):
+    for table in COUNTED:
+        for statement in counter_ddl(table):
+            conn.exec_driver_sql(statement)
+
+
+def backfill_counters(conn):
+    conn.exec_driver_sql('DELETE FROM row_count')
+    for table, keys in COUNTED.items():
+        conn.exec_driver_sql(f"INSERT INTO row_count (name, n) SELECT '{table}', COUNT(*) FROM {table}")
+        for key in keys:
+            key = key.format(row=table)
+            conn.exec_driver_sql(f'INSERT INTO row_count (name, n)'
+                                 f' SELECT {key}, COUNT(*) FROM {table} GROUP BY {key}')
+
+
+cache = {}
+
+
+def row_total(name):
+    # In 'approximate' mode a counter is read at most once per
+    # APPROXIMATE_TOTALS_TTL seconds per process, so busy listing pages do
+    # not touch the database for their pager at all.
+    approximate = app.config['LISTING_TOTALS'] == 'approximate'
+    if approximate:
+        hit = cache.get(name)
+        if hit and hit[1] > time.monotonic():
+            return hit[0]
+    total = db.session.query(RowCount.n).filter_by(name=name).scalar() or 0
+    if approximate:
+        if len(cache) > 10000:
+            cache.clear()
+        cache[name] = (total, time.monotonic() + app.config['APPROXIMATE_TOTALS_TTL'])
+    return total
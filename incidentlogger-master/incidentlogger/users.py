@@ -0,0 +1,47 @@
+from sqlalchemy.orm import make_transient_to_detached
+from incidentlogger import app, db, login_manager
+from incidentlogger.cache import LRUBackend
+from incidentlogger.metrics import metrics
+from incidentlogger.models import User
+
+
+# What the nav bar, ownership checks and account form read. Anything else
+# (the password hash, relationships) is loaded on first access.
+SNAPSHOT = ('id', 'username', 'email', 'email_normalized', 'image_file', 'priv')
+
+
+class UserCache:
+    # Per-process snapshots of logged-in users, so an authenticated request
+    # does not cost a SELECT on user before the view even runs. Routes that
+    # change a user call invalidate(); other workers catch up within
+    # USER_CACHE_TTL seconds.
+
+    def __init__(self, config):
+        self.store = LRUBackend(config, 'user_cache') if config['USER_CACHE_SIZE'] else None
+
+    def load(self, user_id):
+        snapshot = self.store.get(user_id) if self.store else None
+        if snapshot is None:
+            metrics.inc('user_cache.misses')
+            user = db.session.get(User, user_id)
+            if user is not None and self.store:
+                self.store.set(user_id, {name: getattr(user, name) for name in SNAPSHOT},
+                               app.config['USER_CACHE_TTL'])
+            return user
+        # Each hit is a round-trip saved; compare with the requests counter.
+        metrics.inc('user_cache.hits')
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id):
+        if self.store:
+            self.store.delete(user_id)
+
+
+user_cache = UserCache(app.config)
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    return user_cache.load(int(user_id))
@@ -0,0 +1,135 @@
+"""Preforking WSGI server using only the standard library.
+
+For hosts without gunicorn. Reads the same settings as gunicorn.conf.py:
+the master imports the app once, freezes the collector and forks
+`workers` processes, each answering requests with `threads` threads off
+one shared listening socket. A worker exits after about `max_requests`
+requests and the master forks a fresh one.
+
+    python serve.py
+
+SIGTERM or Ctrl-C stops the workers gracefully (killed after
+`graceful_timeout` seconds); SIGHUP recycles them all.
+"""
+import os
+import random
+import runpy
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+settings = runpy.run_path(os.path.join(HERE, 'gunicorn.conf.py'))
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PoolServer(WSGIServer):
+    # Requests go to a fixed pool of threads. A worker only accepts a
+    # connection once one of them is free, leaving the rest in the shared
+    # backlog for idle workers.
+
+    served = 0
+
+    def get_request(self):
+        # The listening socket is non-blocking so idle workers can check
+        # for signals; the connections themselves block.
+        request, address = super().get_request()
+        request.setblocking(True)
+        return request, address
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def serve(server):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    settings['after_fork']()
+
+    limit = settings['max_requests']
+    if limit:
+        limit += random.randint(0, settings['max_requests_jitter'])
+    server.pool = ThreadPoolExecutor(settings['threads'], thread_name_prefix='request')
+    server.slots = threading.BoundedSemaphore(settings['threads'])
+    # handle_request returns after one connection or half a second.
+    server.timeout = 0.5
+    while not stopping and not (limit and server.served >= limit):
+        server.slots.acquire()
+        served = server.served
+        server.handle_request()
+        if server.served == served:
+            server.slots.release()
+    server.pool.shutdown(wait=True)
+
+
+def main():
+    host, port = settings['bind'].rsplit(':', 1)
+    server = PoolServer((host, int(port)), QuietHandler)
+    server.socket.setblocking(False)
+    from run import app
+    server.set_app(app)
+
+    workers = set()
+    stopping = []
+
+    def spawn():
+        settings['before_fork']()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(server)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def signal_workers(signum):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            signal_workers(signal.SIGTERM)
+            signal.alarm(settings['graceful_timeout'])
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, lambda signum, frame: signal_workers(signal.SIGKILL))
+    # Workers finish what they are doing and exit; the loop below replaces them.
+    signal.signal(signal.SIGHUP, lambda signum, frame: signal_workers(signal.SIGTERM))
+
+    print(f"Serving on http://{settings['bind']} with {settings['workers']} workers"
+          f" x {settings['threads']} threads", file=sys.stderr)
+
+    while True:
+        while not stopping and len(workers) < settings['workers']:
+            spawn()
+        if not workers:
+            break
+        pid, status = os.wait()
+        workers.discard(pid)
+
+
+if __name__ == '__main__':
+    main()